@@ -3,14 +3,22 @@ import io
 import sys
 import types
 import zipfile
-import tempfile
 import sqlite3
 import time
-import statistics
-import uuid
+import secrets
 import json
+import shutil
+import re
+import base64
+import hashlib
+import mimetypes
+import functools
+import inspect
+import atexit
+import threading
+import queue
 from datetime import datetime
-from contextlib import redirect_stdout
+from contextlib import redirect_stdout, contextmanager, nullcontext
 from concurrent.futures import ThreadPoolExecutor
 
 import streamlit as st
@@ -33,10 +41,38 @@ st.set_page_config(
     layout="centered",
 )
 
+# ---------- Secrets (lidos 1x por processo; reruns só fazem lookup no dict) ----------
+@st.cache_resource(show_spinner=False)
+def _secrets_snapshot() -> dict:
+    sec = st.secrets
+    tutorial = sec.get("TUTORIAL_URL", "https://www.youtube.com/")
+    return {
+        "BG_URL": sec.get("BG_URL", "").strip(),
+        "PUBLIC_URL": sec.get("PUBLIC_URL", "https://maxfield.fun/").rstrip("/") + "/",
+        "MIN_ZOOM": int(sec.get("MIN_ZOOM", 15)),
+        "MAX_PORTALS": int(sec.get("MAX_PORTALS", 200)),
+        "MAX_URL_LEN": int(sec.get("MAX_URL_LEN", 6000)),
+        "TUTORIAL_URL": tutorial,
+        "TUTORIAL_IITC_URL": sec.get("TUTORIAL_IITC_URL", tutorial),
+        "ENABLE_FORUM": bool(sec.get("ENABLE_FORUM", True)),
+        "GOOGLE_API_KEY": sec.get("GOOGLE_API_KEY", None),
+        "GOOGLE_API_SECRET": sec.get("GOOGLE_API_SECRET", None),
+        "ADMIN_CODE": sec.get("ADMIN_CODE", ""),
+        "COMMENTS_ENABLED": bool(sec.get("COMMENTS_ENABLED", True)),
+        "MAX_IMG_MB": int(sec.get("MAX_IMG_MB", 2)),
+        "MAX_IMGS_PER_POST": int(sec.get("MAX_IMGS_PER_POST", 3)),
+        "TELEGRAM_USER": sec.get("TELEGRAM_USER", "@HiperionBR"),
+        "PIX_QR_URL": sec.get("PIX_QR_URL", ""),
+        "NEWS_MD": sec.get("NEWS_MD", "").strip(),
+    }
+
+SECRETS = _secrets_snapshot()
+
 # ===== Fundo + cartão responsivo (claro/escuro automático) + Abas grandes =====
-bg_url = st.secrets.get("BG_URL", "").strip()
-st.markdown(
-    f"""
+# CSS montado 1x por valor de BG_URL; reruns reaproveitam a mesma string
+@functools.lru_cache(maxsize=4)
+def _css(bg_url: str) -> str:
+    return f"""
     <style>
     .stApp {{
       {"background: url('" + bg_url + "') no-repeat center center fixed; background-size: cover;" if bg_url else ""}
@@ -70,6 +106,9 @@ st.markdown(
     .mf-chip.enl {{ background:#25c025; }}
     .mf-chip.res {{ background:#2b6dff; }}
 
+    /* Avatares (data URI) */
+    .mf-avatar {{ border-radius:8px; height:auto; }}
+
     /* Mini badge de contagem */
     .mf-badge {{
       display:inline-block; padding:2px 8px; border-radius:999px; font-size:11px; margin-left:8px;
@@ -89,16 +128,32 @@ st.markdown(
       font-size: 15px !important;
     }}
     </style>
-    """,
-    unsafe_allow_html=True
-)
+    """
+
+bg_url = SECRETS["BG_URL"]
+st.markdown(_css(bg_url), unsafe_allow_html=True)
 
 # ---------- Persistência simples (SQLite) ----------
+DB_POOL_SIZE = 8
+
+def _open_conn(db_path: str) -> sqlite3.Connection:
+    # autocommit (isolation_level=None): escritas em lote usam db_tx() com BEGIN explícito
+    # cache de statements maior: os helpers do fórum/login reaproveitam poucas queries fixas
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, cached_statements=256)
+    # WAL: leitores não bloqueiam o escritor; NORMAL dispensa fsync a cada commit (seguro em WAL)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+    return conn
+
 @st.cache_resource(show_spinner=False)
-def get_db():
+def db_pool():
     os.makedirs("data", exist_ok=True)
     db_path = os.path.join("data", "app.db")
-    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn = _open_conn(db_path)
+    # schema inteiro numa transação só (1 commit/fsync no cold start em vez de 1 por statement)
+    conn.execute("BEGIN")
     # métricas e runs
     conn.execute("""
         CREATE TABLE IF NOT EXISTS metrics (
@@ -106,8 +161,8 @@ def get_db():
             value INTEGER NOT NULL
         )
     """)
-    for k in ("visits", "plans_completed"):
-        conn.execute("INSERT OR IGNORE INTO metrics(key, value) VALUES (?, 0)", (k,))
+    conn.executemany("INSERT OR IGNORE INTO metrics(key, value) VALUES (?, 0)",
+                     [("visits",), ("plans_completed",)])
     conn.execute("""
         CREATE TABLE IF NOT EXISTS runs(
             ts INTEGER, n_portais INTEGER, num_cpus INTEGER, gif INTEGER, dur_s REAL
@@ -128,6 +183,11 @@ def get_db():
             out_dir TEXT
         )
     """)
+    # list_jobs_recent (uid + ts), housekeeping (ts), ETA/métricas (gif + ts)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_uid_ts ON jobs(uid, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_ts ON jobs(ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_runs_gif_ts ON runs(gif, ts)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_runs_ts ON runs(ts)")
     conn.execute("""
         CREATE TABLE IF NOT EXISTS housekeeping(
             key TEXT PRIMARY KEY,
@@ -155,6 +215,7 @@ def get_db():
     try:
         conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_username_lc ON users(username_lc)")
     except Exception: pass
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)")
 
     conn.execute("""
         CREATE TABLE IF NOT EXISTS sessions(
@@ -167,16 +228,20 @@ def get_db():
     conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_user ON sessions(user_id)")
 
     conn.execute("CREATE TABLE IF NOT EXISTS forum_posts(id INTEGER PRIMARY KEY AUTOINCREMENT)")
+    backfill_n_comments = "n_comments" not in colset("forum_posts")
     for col, decl in [
         ("cat","TEXT"),("title","TEXT"),("body_md","TEXT"),
         ("author_id","INTEGER"),("author_name","TEXT"),("author_faction","TEXT"),
         ("created_ts","INTEGER"),("updated_ts","INTEGER"),
         ("images_json","TEXT"),("is_pinned","INTEGER DEFAULT 0"),
+        ("n_comments","INTEGER NOT NULL DEFAULT 0"),
         # legados
         ("ts","INTEGER"),("uid","TEXT"),("body","TEXT"),("category","TEXT"),
     ]: ensure_col("forum_posts", col, decl)
     conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_cat ON forum_posts(cat)")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_author ON forum_posts(author_id)")
+    # cobre o WHERE cat=? ORDER BY is_pinned DESC, created_ts DESC da listagem (sem sort temporário)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_posts_cat_pin_ts ON forum_posts(cat, is_pinned, created_ts)")
 
     conn.execute("CREATE TABLE IF NOT EXISTS forum_comments(id INTEGER PRIMARY KEY AUTOINCREMENT)")
     for col, decl in [
@@ -188,52 +253,209 @@ def get_db():
     ]: ensure_col("forum_comments", col, decl)
     conn.execute("CREATE INDEX IF NOT EXISTS idx_comments_postid ON forum_comments(post_id)")
     conn.execute("CREATE INDEX IF NOT EXISTS idx_comments_author ON forum_comments(author_id)")
+    if backfill_n_comments:
+        # contador desnormalizado de comentários visíveis; preenche 1x para posts antigos
+        conn.execute("""
+            UPDATE forum_posts SET n_comments = (
+                SELECT COUNT(*) FROM forum_comments c
+                 WHERE c.post_id = forum_posts.id AND c.deleted_ts IS NULL)
+        """)
 
     conn.commit()
-    return conn
+
+    # conexões pré-abertas, uma por uso simultâneo (sessões + worker do job)
+    pool = queue.Queue()
+    pool.put(conn)
+    for _ in range(DB_POOL_SIZE - 1):
+        pool.put(_open_conn(db_path))
+    return {"queue": pool, "path": db_path}
+
+@contextmanager
+def db_conn(pool=None):
+    # pool explícito p/ threads fora do script (timer/atexit), onde st.cache_resource não tem contexto
+    pool = pool or db_pool()
+    try:
+        conn = pool["queue"].get(timeout=5)
+        pooled = True
+    except queue.Empty:
+        # pool esgotado (ex.: uso aninhado sob carga): conexão avulsa em vez de travar
+        conn = _open_conn(pool["path"])
+        pooled = False
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        if pooled:
+            pool["queue"].put(conn)
+        else:
+            conn.close()
+
+@contextmanager
+def db_tx(pool=None):
+    # 1 transação (1 commit) para várias escritas relacionadas
+    with db_conn(pool) as conn:
+        conn.execute("BEGIN")
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+# incrementos de métricas acumulam em memória e vão ao banco no máx. a cada 5s (1 commit p/ N visitas)
+METRICS_FLUSH_S = 5.0
+
+@st.cache_resource(show_spinner=False)
+def _metric_buffer():
+    buf = {"pending": {}, "last": time.time(), "lock": threading.Lock(), "timer": None, "pool": db_pool()}
+    atexit.register(_flush_metrics, buf, True)
+    return buf
+
+def _flush_metrics(buf, force: bool = False):
+    with buf["lock"]:
+        if not buf["pending"] or (not force and time.time() - buf["last"] < METRICS_FLUSH_S):
+            return
+        items = [(d, k) for k, d in buf["pending"].items()]
+        buf["pending"] = {}
+        buf["last"] = time.time()
+    try:
+        with db_tx(buf["pool"]) as conn:
+            conn.executemany("UPDATE metrics SET value = value + ? WHERE key = ?", items)
+    except Exception:
+        # banco ocupado/erro transitório: devolve os incrementos ao buffer e agenda nova tentativa
+        with buf["lock"]:
+            for d, k in items:
+                buf["pending"][k] = buf["pending"].get(k, 0) + d
+            _arm_flush_timer(buf)
+
+def _arm_flush_timer(buf):
+    # chamado com buf["lock"] na mão; sem novos incrementos, o timer garante o flush em até METRICS_FLUSH_S
+    if buf["timer"] is None:
+        t = buf["timer"] = threading.Timer(METRICS_FLUSH_S, _flush_metrics_idle, (buf,))
+        t.daemon = True
+        t.start()
+
+def _flush_metrics_idle(buf):
+    with buf["lock"]:
+        buf["timer"] = None
+    _flush_metrics(buf, True)
 
 def inc_metric(key: str, delta: int = 1):
-    conn = get_db()
-    conn.execute("UPDATE metrics SET value = value + ? WHERE key = ?", (delta, key))
-    conn.commit()
+    buf = _metric_buffer()
+    with buf["lock"]:
+        buf["pending"][key] = buf["pending"].get(key, 0) + delta
+        _arm_flush_timer(buf)
+    _flush_metrics(buf)
 
 def get_metric(key: str) -> int:
-    cur = get_db().execute("SELECT value FROM metrics WHERE key=?", (key,))
-    row = cur.fetchone()
-    return int(row[0]) if row else 0
+    buf = _metric_buffer()
+    _flush_metrics(buf)
+    with db_conn() as conn:
+        row = conn.execute("SELECT value FROM metrics WHERE key=?", (key,)).fetchone()
+    with buf["lock"]:
+        pend = buf["pending"].get(key, 0)
+    return (int(row[0]) if row else 0) + pend
 
 # histórico de durações p/ ETA
-def record_run(n_portais:int, num_cpus:int, gif:bool, dur_s:float):
-    conn = get_db()
-    conn.execute("INSERT INTO runs(ts,n_portais,num_cpus,gif,dur_s) VALUES (?,?,?,?,?)",
-                 (int(time.time()), n_portais, num_cpus, 1 if gif else 0, float(dur_s)))
-    conn.commit()
+# Quantil por P² (Jain & Chlamtac, 1985): 5 marcadores, O(1) por amostra, sem guardar janela
+class P2Quantile:
+    def __init__(self, p:float=0.5):
+        self.p = p
+        self.q:list[float] = []                      # alturas dos marcadores
+        self.n = [1, 2, 3, 4, 5]                     # posições reais
+        self.np_ = [1, 1+2*p, 1+4*p, 3+2*p, 5]       # posições desejadas
+        self.dn = [0, p/2, p, (1+p)/2, 1]
+
+    def update(self, x:float):
+        q, n = self.q, self.n
+        if len(q) < 5:
+            q.append(x)
+            if len(q) == 5: q.sort()
+            return
+        if x < q[0]:
+            q[0] = x; k = 0
+        elif x >= q[4]:
+            q[4] = x; k = 3
+        else:
+            k = next(i for i in range(4) if q[i] <= x < q[i+1])
+        for i in range(k+1, 5): n[i] += 1
+        for i in range(5): self.np_[i] += self.dn[i]
+        for i in (1, 2, 3):
+            d = self.np_[i] - n[i]
+            if (d >= 1 and n[i+1]-n[i] > 1) or (d <= -1 and n[i-1]-n[i] < -1):
+                d = 1 if d > 0 else -1
+                qp = q[i] + d/(n[i+1]-n[i-1]) * ((n[i]-n[i-1]+d)*(q[i+1]-q[i])/(n[i+1]-n[i])
+                                                + (n[i+1]-n[i]-d)*(q[i]-q[i-1])/(n[i]-n[i-1]))
+                if not (q[i-1] < qp < q[i+1]):
+                    qp = q[i] + d*(q[i+d]-q[i])/(n[i+d]-n[i])
+                q[i] = qp; n[i] += d
+
+    def quantile(self) -> float|None:
+        q = self.q
+        if not q: return None
+        if len(q) < 5:
+            # poucas amostras: mediana exata
+            s = sorted(q); m = len(s) // 2
+            return s[m] if len(s) % 2 else (s[m-1] + s[m]) / 2
+        return q[2]
+
+@st.cache_resource(show_spinner=False)
+def eta_sketches():
+    # um estimador por flag de GIF, semeado uma vez com as últimas 50 execuções
+    sk = {}
+    for g in (0, 1):
+        est = P2Quantile(0.5)
+        with db_conn() as conn:
+            rows = conn.execute("""
+                SELECT pp FROM (
+                    SELECT ts, dur_s * 1.0 / n_portais AS pp FROM runs
+                     WHERE gif=? AND n_portais>0 ORDER BY ts DESC LIMIT 50
+                ) ORDER BY ts
+            """, (g,)).fetchall()
+        for (pp,) in rows: est.update(pp)
+        sk[g] = est
+    return sk, threading.Lock()
+
+def record_run(n_portais:int, num_cpus:int, gif:bool, dur_s:float, conn=None):
+    with (nullcontext(conn) if conn is not None else db_tx()) as c:
+        c.execute("INSERT INTO runs(ts,n_portais,num_cpus,gif,dur_s) VALUES (?,?,?,?,?)",
+                  (int(time.time()), n_portais, num_cpus, 1 if gif else 0, float(dur_s)))
+    if n_portais > 0:
+        sk, lock = eta_sketches()
+        with lock:
+            sk[1 if gif else 0].update(float(dur_s) / n_portais)
 
 def add_job_row(job_id:str, uid:str, n_portais:int, num_cpus:int, team:str,
-                output_csv:bool, fazer_gif:bool, dur_s:float, out_dir:str):
-    conn = get_db()
-    conn.execute("""
-        INSERT OR REPLACE INTO jobs(job_id,ts,uid,n_portais,num_cpus,team,output_csv,fazer_gif,dur_s,out_dir)
-        VALUES (?,?,?,?,?,?,?,?,?,?)
-    """, (job_id, int(time.time()), uid, n_portais, num_cpus, team, 1 if output_csv else 0, 1 if fazer_gif else 0, float(dur_s), out_dir))
-    conn.commit()
+                output_csv:bool, fazer_gif:bool, dur_s:float, out_dir:str, conn=None):
+    with (nullcontext(conn) if conn is not None else db_tx()) as c:
+        c.execute("""
+            INSERT OR REPLACE INTO jobs(job_id,ts,uid,n_portais,num_cpus,team,output_csv,fazer_gif,dur_s,out_dir)
+            VALUES (?,?,?,?,?,?,?,?,?,?)
+        """, (job_id, int(time.time()), uid, n_portais, num_cpus, team, 1 if output_csv else 0, 1 if fazer_gif else 0, float(dur_s), out_dir))
 
 def list_jobs_recent(uid:str|None, within_hours:int=24, limit:int=50):
-    conn = get_db()
     min_ts = int(time.time()) - within_hours*3600
-    if uid:
-        cur = conn.execute(
-            "SELECT job_id,ts,uid,n_portais,num_cpus,team,output_csv,fazer_gif,dur_s,out_dir "
-            "FROM jobs WHERE ts>=? AND uid=? ORDER BY ts DESC LIMIT ?",
-            (min_ts, uid, limit)
-        )
-    else:
-        cur = conn.execute(
-            "SELECT job_id,ts,uid,n_portais,num_cpus,team,output_csv,fazer_gif,dur_s,out_dir "
-            "FROM jobs WHERE ts>=? ORDER BY ts DESC LIMIT ?",
-            (min_ts, limit)
-        )
-    return cur.fetchall()
+    with db_conn() as conn:
+        if uid:
+            cur = conn.execute(
+                "SELECT job_id,ts,uid,n_portais,num_cpus,team,output_csv,fazer_gif,dur_s,out_dir "
+                "FROM jobs WHERE ts>=? AND uid=? ORDER BY ts DESC LIMIT ?",
+                (min_ts, uid, limit)
+            )
+        else:
+            cur = conn.execute(
+                "SELECT job_id,ts,uid,n_portais,num_cpus,team,output_csv,fazer_gif,dur_s,out_dir "
+                "FROM jobs WHERE ts>=? ORDER BY ts DESC LIMIT ?",
+                (min_ts, limit)
+            )
+        return cur.fetchall()
+
+def _pp_median(gif:int) -> float|None:
+    # mediana corrente (s/portal) do P²: leitura O(1), já atualizada por record_run
+    sk, lock = eta_sketches()
+    with lock:
+        return sk[gif].quantile()
 
 def estimate_eta_s(n_portais:int, num_cpus:int, gif:bool) -> float:
     base_pp = 0.35 if not gif else 0.55
@@ -241,24 +463,16 @@ def estimate_eta_s(n_portais:int, num_cpus:int, gif:bool) -> float:
     cpu_factor = 1.0 / max(1.0, (0.6 + 0.5*min(num_cpus, 8)**0.5))
     est = (base_overhead + base_pp*n_portais) * cpu_factor
 
-    cur = get_db().execute("""
-        SELECT dur_s, n_portais FROM runs
-        WHERE gif=? ORDER BY ts DESC LIMIT 50
-    """, (1 if gif else 0,))
-    rows = cur.fetchall()
-    if rows:
-        pps = [r[0]/max(1, r[1]) for r in rows if r[1] > 0]
-        if pps:
-            pp_med = statistics.median(pps)
-            est = (pp_med * n_portais) * cpu_factor + (1.5 if not gif else 4.0)
+    pp_med = _pp_median(1 if gif else 0)
+    if pp_med is not None:
+        est = (pp_med * n_portais) * cpu_factor + (1.5 if not gif else 4.0)
     return max(2.0, est)
 
 # ---------- Housekeeping diário ----------
 def daily_cleanup(retain_hours:int=24):
-    conn = get_db()
     today = datetime.now().strftime("%Y-%m-%d")
-    cur = conn.execute("SELECT value FROM housekeeping WHERE key='last_cleanup'")
-    row = cur.fetchone()
+    with db_conn() as conn:
+        row = conn.execute("SELECT value FROM housekeeping WHERE key='last_cleanup'").fetchone()
     last = row[0] if row else None
     if last == today:
         return
@@ -266,27 +480,23 @@ def daily_cleanup(retain_hours:int=24):
     root = os.path.join("data", "jobs")
     now = time.time()
     if os.path.isdir(root):
-        for jid in os.listdir(root):
-            d = os.path.join(root, jid)
-            try:
-                st_mtime = os.path.getmtime(d)
-            except FileNotFoundError:
-                continue
-            if now - st_mtime > retain_hours*3600:
+        # scandir reaproveita o stat do dirent; rmtree apaga a árvore toda de uma vez
+        with os.scandir(root) as it:
+            for entry in it:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
                 try:
-                    for base, _, files in os.walk(d, topdown=False):
-                        for fn in files:
-                            try: os.remove(os.path.join(base, fn))
-                            except: pass
-                        try: os.rmdir(base)
-                        except: pass
-                except: pass
+                    st_mtime = entry.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                if now - st_mtime > retain_hours*3600:
+                    shutil.rmtree(entry.path, ignore_errors=True)
 
     min_ts = int(time.time()) - retain_hours*3600
-    conn.execute("DELETE FROM jobs WHERE ts < ?", (min_ts,))
-    conn.execute("DELETE FROM runs WHERE ts < ?", (min_ts,))
-    conn.execute("INSERT OR REPLACE INTO housekeeping(key,value) VALUES('last_cleanup', ?)", (today,))
-    conn.commit()
+    with db_tx() as conn:
+        conn.execute("DELETE FROM jobs WHERE ts < ?", (min_ts,))
+        conn.execute("DELETE FROM runs WHERE ts < ?", (min_ts,))
+        conn.execute("INSERT OR REPLACE INTO housekeeping(key,value) VALUES('last_cleanup', ?)", (today,))
 
 daily_cleanup(retain_hours=24)
 
@@ -296,62 +506,79 @@ if "visit_counted" not in st.session_state:
     st.session_state["visit_counted"] = True
 
 # ---------- Utilitários ----------
+def _short_id(nbytes: int = 6) -> str:
+    # 48 bits aleatórios em base32 minúsculo (10 chars, seguro p/ URL e nome de pasta)
+    return base64.b32encode(os.urandom(nbytes)).decode("ascii").rstrip("=").lower()
+
+# linha útil = 1º caractere não-branco que não seja '#'
+_PORTAL_LINE_RE = re.compile(r"^[^\S\n]*[^#\s]", re.M)
+# "Nome; URL...pll=LAT,LON" — pll só vale no 2º campo, como no split(";") antigo
+_PORTAL_RE = re.compile(
+    r"^[^\S\n]*([^#\s;][^;\n]*)?;(?:(?!pll=)[^;\n])*pll=(-?\d+(?:\.\d+)?),(-?\d+(?:\.\d+)?)"
+    r"(?=&|[^\S\n]*(?:;|$))", re.M)
+
 def contar_portais(texto: str) -> int:
-    cnt = 0
-    for ln in texto.splitlines():
-        s = ln.strip()
-        if not s or s.startswith("#"):
-            continue
-        cnt += 1
-    return cnt
+    return sum(1 for _ in _PORTAL_LINE_RE.finditer(texto))
+
+# BOM/zero-width somem, NBSP vira espaço — uma passada só em C
+_INVIS_TABLE = str.maketrans({"\ufeff": None, "\u200b": None, "\u200c": None,
+                              "\u200d": None, "\u2060": None, "\xa0": " "})
 
+@functools.lru_cache(maxsize=8)  # preview e submit limpam o mesmo texto
 def clean_invisibles(s: str) -> str:
-    bad = ["\ufeff", "\u200b", "\u200c", "\u200d", "\u2060", "\xa0"]
-    for ch in bad:
-        s = s.replace(ch, " " if ch == "\xa0" else "")
-    return s
+    return s.translate(_INVIS_TABLE)
 
 def extract_points(texto: str):
-    pts = []
-    for ln in texto.splitlines():
-        s = ln.strip()
-        if not s or s.startswith("#"): continue
-        try:
-            parts = s.split(";")
-            name = parts[0].strip()
-            url = parts[1].strip() if len(parts) > 1 else ""
-            if "pll=" in url:
-                pll = url.split("pll=")[1].split("&")[0]
-                lat_s, lon_s = pll.split(",")
-                lat = float(lat_s); lon = float(lon_s)
-                pts.append({"name": name or "Portal", "lat": lat, "lon": lon})
-        except Exception:
-            continue
-    return pts
+    # colunas separadas (nomes, lats, lons): o DataFrame da prévia é montado sem transpor
+    import numpy as np
+    ms = _PORTAL_RE.findall(texto)
+    names = [(m[0] or "").strip() or "Portal" for m in ms]
+    lats = np.array([m[1] for m in ms], dtype=np.float64)
+    lons = np.array([m[2] for m in ms], dtype=np.float64)
+    return names, lats, lons
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _preview_points(texto: str):
+    # prévia do mapa: mesmo texto (rerun sem edição) não é re-parseado; centro já vem calculado
+    import pandas as pd
+    names, lats, lons = extract_points(clean_invisibles(texto))
+    df = pd.DataFrame({"name": names, "lat": lats, "lon": lons}, copy=False)
+    center = (float(lats.mean()), float(lons.mean())) if len(lats) else (0.0, 0.0)
+    return df, center
+
+# ---------- Compat: fragmentos (st.fragment nas versões novas) ----------
+_fragment = getattr(st, "fragment", None) or st.experimental_fragment
+
+# st.rerun(scope="fragment") (1.37+) refaz só o fragmento atual; nas antigas refaz a página
+if "scope" in inspect.signature(st.rerun).parameters:
+    def _rerun_fragment():
+        st.rerun(scope="fragment")
+else:
+    _rerun_fragment = st.rerun
 
 # ---------- Helpers de QueryString ----------
-def qp_get(name: str, default: str = "") -> str:
-    try:
-        params = getattr(st, "query_params", None)
-        if params is not None:
-            return params.get(name) or default
-        else:
-            qp = st.experimental_get_query_params()
-            return qp.get(name, [default])[0]
-    except Exception:
-        return default
+# API escolhida 1x no import (st.query_params nas versões novas, experimental_* nas antigas)
+_QP = getattr(st, "query_params", None)
 
-def qp_set(**kwargs):
-    try:
-        params = getattr(st, "query_params", None)
-        if params is not None:
-            for k, v in kwargs.items():
-                if v is None:
-                    try: del params[k]
-                    except KeyError: pass
-                else:
-                    params[k] = v
-        else:
+if _QP is not None:
+    def qp_get(name: str, default: str = "") -> str:
+        return _QP.get(name) or default
+
+    def qp_set(**kwargs):
+        for k, v in kwargs.items():
+            if v is None:
+                _QP.pop(k, None)
+            else:
+                _QP[k] = v
+else:
+    def qp_get(name: str, default: str = "") -> str:
+        try:
+            return st.experimental_get_query_params().get(name, [default])[0]
+        except Exception:
+            return default
+
+    def qp_set(**kwargs):
+        try:
             cur = st.experimental_get_query_params()
             for k, v in kwargs.items():
                 if v is None:
@@ -359,27 +586,32 @@ def qp_set(**kwargs):
                 else:
                     cur[k] = [v]
             st.experimental_set_query_params(**cur)
-    except Exception:
-        pass
+        except Exception:
+            pass
 
 # ---------- Identificador anônimo ----------
 if "uid" not in st.session_state:
     cur_uid = qp_get("uid", "")
     if not cur_uid:
-        cur_uid = uuid.uuid4().hex[:8]
+        cur_uid = _short_id()
         qp_set(uid=cur_uid)
     st.session_state["uid"] = cur_uid
 UID = st.session_state["uid"]
 
 # ---------- Parâmetros públicos userscript ----------
-PUBLIC_URL = (st.secrets.get("PUBLIC_URL", "https://maxfield.fun/").rstrip("/") + "/")
-MIN_ZOOM = int(st.secrets.get("MIN_ZOOM", 15))
-MAX_PORTALS = int(st.secrets.get("MAX_PORTALS", 200))
-MAX_URL_LEN = int(st.secrets.get("MAX_URL_LEN", 6000))
+PUBLIC_URL = SECRETS["PUBLIC_URL"]
+MIN_ZOOM = SECRETS["MIN_ZOOM"]
+MAX_PORTALS = SECRETS["MAX_PORTALS"]
+MAX_URL_LEN = SECRETS["MAX_URL_LEN"]
 
 DEST = PUBLIC_URL
 
 # ---------- Exemplo de entrada (.txt) ----------
+@functools.lru_cache(maxsize=8)
+def _utf8(s: str) -> bytes:
+    # textos fixos dos downloads: codifica 1x por processo, não a cada rerun
+    return s.encode("utf-8")
+
 EXEMPLO_TXT = """# Exemplo de arquivo de portais (uma linha por portal)
 # Formato: Nome do Portal; URL do Intel (com pll=LAT,LON)
 Portal 1; https://intel.ingress.com/intel?pll=-10.912345,-37.065432
@@ -404,9 +636,9 @@ function wrapper(plugin_info) {
   window.plugin.maxfieldSender = {};
   const self = window.plugin.maxfieldSender;
 
-  self.MIN_ZOOM    = 15;
-  self.MAX_PORTALS = 200;
-  self.MAX_URL_LEN = 6000;
+  self.MIN_ZOOM    = __MIN_ZOOM__;
+  self.MAX_PORTALS = __MAX_PORTALS__;
+  self.MAX_URL_LEN = __MAX_URL_LEN__;
   self.DEST        = '__DEST__';
 
   const isMobile = /IITC|Android|Mobile/i.test(navigator.userAgent) || !!window.isApp;
@@ -673,12 +905,17 @@ script.appendChild(document.createTextNode('(' + wrapper + ')(' + JSON.stringify
 (document.body || document.documentElement).appendChild(script);
 """
 
-IITC_USERSCRIPT = (IITC_USERSCRIPT_TEMPLATE
-    .replace("__DEST__", DEST)
-    .replace("self.MIN_ZOOM    = 15;",   f"self.MIN_ZOOM    = {MIN_ZOOM};")
-    .replace("self.MAX_PORTALS = 200;",  f"self.MAX_PORTALS = {MAX_PORTALS};")
-    .replace("self.MAX_URL_LEN = 6000;", f"self.MAX_URL_LEN = {MAX_URL_LEN};")
-)
+# placeholders __X__ trocados numa passada só (o JS tem chaves demais p/ str.format)
+_USERSCRIPT_PH = re.compile(r"__(DEST|MIN_ZOOM|MAX_PORTALS|MAX_URL_LEN)__")
+
+@st.cache_resource(show_spinner=False)
+def build_userscript(dest:str, min_zoom:int, max_portals:int, max_url_len:int) -> bytes:
+    vals = {"DEST": dest, "MIN_ZOOM": str(min_zoom),
+            "MAX_PORTALS": str(max_portals), "MAX_URL_LEN": str(max_url_len)}
+    # já sai em UTF-8: o download usa os mesmos bytes em todo rerun
+    return _USERSCRIPT_PH.sub(lambda m: vals[m[1]], IITC_USERSCRIPT_TEMPLATE).encode("utf-8")
+
+IITC_USERSCRIPT_BYTES = build_userscript(DEST, MIN_ZOOM, MAX_PORTALS, MAX_URL_LEN)
 
 # ---------- Título + KPIs ----------
 st.title("Ingress Maxfield — Gerador de Planos")
@@ -702,20 +939,20 @@ st.markdown(
 
 b1, b2, b3, b4 = st.columns(4)
 with b1:
-    st.download_button("📄 Baixar modelo (.txt)", EXEMPLO_TXT.encode("utf-8"),
+    st.download_button("📄 Baixar modelo (.txt)", _utf8(EXEMPLO_TXT),
                        file_name="modelo_portais.txt", mime="text/plain")
 with b2:
-    st.download_button("🧩 Baixar plugin IITC", IITC_USERSCRIPT.encode("utf-8"),
+    st.download_button("🧩 Baixar plugin IITC", IITC_USERSCRIPT_BYTES,
                        file_name="maxfield_iitc.user.js", mime="application/javascript")
 with b3:
-    TUTORIAL_URL = st.secrets.get("TUTORIAL_URL", "https://www.youtube.com/")
+    TUTORIAL_URL = SECRETS["TUTORIAL_URL"]
     st.link_button("▶️ Tutorial (normal)", TUTORIAL_URL)
 with b4:
-    TUTORIAL_IITC_URL = st.secrets.get("TUTORIAL_IITC_URL", TUTORIAL_URL)
+    TUTORIAL_IITC_URL = SECRETS["TUTORIAL_IITC_URL"]
     st.link_button("▶️ Tutorial (via IITC)", TUTORIAL_IITC_URL)
 
 # ---------- PWA Lite ----------
-st.markdown("""
+PWA_SCRIPT = """
 <script>
 try {
   const manifest = {
@@ -745,27 +982,19 @@ try {
   }
 } catch(e) {}
 </script>
-""", unsafe_allow_html=True)
+"""
+st.markdown(PWA_SCRIPT, unsafe_allow_html=True)
 
 # ---------- Entrada pré-preenchida por ?list= ----------
 def get_prefill_list() -> str:
-    try:
-        params = getattr(st, "query_params", None)
-        if params is not None:
-            return (params.get("list") or "")
-        else:
-            qp = st.experimental_get_query_params()
-            return qp.get("list", [""])[0]
-    except Exception:
-        return ""
-
-prefill_text = get_prefill_list()
+    return qp_get("list", "")
 
 # ---- sessão: chaves e limpeza adiada do campo de texto ----
 if "uploader_key" not in st.session_state:
     st.session_state["uploader_key"] = 0
 if "txt_content" not in st.session_state:
-    st.session_state["txt_content"] = prefill_text or ""
+    # ?list= (até alguns KB) só é lido na 1ª execução da sessão
+    st.session_state["txt_content"] = get_prefill_list()
 if st.session_state.get("_clear_text", False):
     st.session_state["_clear_text"] = False
     st.session_state["txt_content"] = ""
@@ -775,9 +1004,20 @@ if st.session_state.get("_clear_text", False):
 def job_manager():
     return {
         "executor": ThreadPoolExecutor(max_workers=1),
-        "jobs": {}
+        "jobs": {},
+        "plans": {},  # chave da entrada -> pasta do último job ok com ela
     }
 
+PLAN_CACHE_MAX = 32
+
+def _plan_key(kwargs: dict) -> str:
+    # mesmo conteúdo + mesmos parâmetros => mesmo plano; CPUs não mudam o resultado
+    # e das chaves da API só entra "tem ou não mapa de fundo" (segredos fora da chave)
+    h = hashlib.sha256(kwargs["portal_bytes"])
+    h.update(repr((kwargs["num_agents"], kwargs["res_colors"], kwargs["output_csv"],
+                   kwargs["fazer_gif"], bool(kwargs["google_api_key"]))).encode())
+    return h.hexdigest()
+
 def prune_jobs(max_jobs:int = 5, max_age_s:int = 3600):
     jm = job_manager()
     now = time.time()
@@ -809,14 +1049,64 @@ def run_job(kwargs: dict) -> dict:
 def start_job(kwargs: dict, eta_s: float, meta: dict) -> str:
     prune_jobs()
     jm = job_manager()
-    job_id = uuid.uuid4().hex[:8]
-    fut = jm["executor"].submit(run_job, kwargs | {"job_id": job_id, "team": meta.get("team","")})
-    jm["jobs"][job_id] = {"future": fut, "t0": time.time(), "eta": eta_s, "meta": meta, "done": False, "out": None}
+    job_id = _short_id()
+    # entrada idêntica a um job anterior: o worker copia os artefatos em vez de rodar o maxfield
+    key = _plan_key(kwargs)
+    rec = {"future": None, "t0": time.time(), "eta": eta_s, "meta": meta, "done": False, "out": None, "plan_key": key}
+    fut = jm["executor"].submit(run_job, kwargs | {"job_id": job_id, "team": meta.get("team",""),
+                                                   "reuse_dir": jm["plans"].get(key)})
+    rec["future"] = fut
+    jm["jobs"][job_id] = rec
+    # o próprio future marca o job como concluído; a UI só consulta rec["done"]
+    fut.add_done_callback(functools.partial(_mark_job_done, rec, jm["plans"]))
     return job_id
 
+def _mark_job_done(rec: dict, plans: dict, fut):
+    if rec.get("done"):
+        return  # cancelamento já registrado pela UI
+    if fut.cancelled():
+        rec["out"] = {"ok": False, "error": "Job cancelado pelo usuário"}
+    else:
+        rec["out"] = fut.result()
+        if rec["out"].get("ok"):
+            plans.pop(rec["plan_key"], None)  # reinsere no fim: dict vira um LRU simples
+            plans[rec["plan_key"]] = rec["out"]["result"]["outdir"]
+            while len(plans) > PLAN_CACHE_MAX:
+                plans.pop(next(iter(plans)))
+    rec["done"] = True
+
 def get_job(job_id: str):
     return job_manager()["jobs"].get(job_id)
 
+def detach_job_result(job: dict):
+    # a sessão já copiou o resultado (só caminhos/metadados): solta a referência ao future
+    job["future"] = None
+
+def finish_job(job_id: str, job: dict, out: dict, res: dict, uid: str):
+    # métricas + run + linha do job; run e job num commit só
+    inc_metric("plans_completed", 1)
+    meta = job.get("meta", {})
+    dur_s = float(out.get("elapsed", 0.0))
+    try:
+        with db_tx() as conn:
+            if not res.get("reused"):  # cópia de job anterior não conta p/ estimar o ETA
+                record_run(int(meta.get("n_portais", 0)), int(meta.get("num_cpus", 0)),
+                           bool(meta.get("gif", False)), dur_s, conn=conn)
+            add_job_row(
+                job_id=out.get("job_id", job_id),
+                uid=uid,
+                n_portais=int(meta.get("n_portais", 0)),
+                num_cpus=int(meta.get("num_cpus", 0)),
+                team=str(meta.get("team","")),
+                output_csv=bool(meta.get("output_csv", True)),
+                fazer_gif=bool(meta.get("gif", False)),
+                dur_s=dur_s,
+                out_dir=str(res.get("outdir","")),
+                conn=conn,
+            )
+    except Exception:
+        pass
+
 # ---------- Restaura job por URL ----------
 if "job_id" not in st.session_state:
     jid = qp_get("job", "")
@@ -827,6 +1117,36 @@ if "job_id" not in st.session_state:
             qp_set(job=None)
 
 # ---------- Processamento principal (agora sem @st.cache_data) ----------
+# formatos já comprimidos: deflate só gastaria CPU
+_ZIP_STORED_EXTS = {"png", "gif", "jpg", "jpeg", "zip", "webp"}
+
+_PLAN_REUSE_SKIP = shutil.ignore_patterns("*.zip", "maxfield_log.txt", "portais.txt")
+
+def _link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def _copy_plan_outputs(src: str, outdir: str) -> bool:
+    # árvore de artefatos (inclusive frames/) de um job com a mesma entrada; hardlink quando dá
+    # (mesmo disco), senão cópia. log/zip/portais são do job novo.
+    # False (pasta sumiu/cópia falhou) => roda o maxfield
+    try:
+        shutil.copytree(src, outdir, ignore=_PLAN_REUSE_SKIP, copy_function=_link_or_copy, dirs_exist_ok=True)
+    except OSError:
+        # desfaz os links: o maxfield reescreveria o mesmo inode do job antigo
+        with os.scandir(outdir) as it:
+            for e in it:
+                if e.name == "portais.txt": continue
+                if e.is_dir(follow_symlinks=False): shutil.rmtree(e.path, ignore_errors=True)
+                else:
+                    try: os.unlink(e.path)
+                    except OSError: pass
+        return False
+    print(f"[{time.strftime('%H:%M:%S')}] Entrada idêntica ao job {os.path.basename(src)}: artefatos reaproveitados")
+    return True
+
 def processar_plano(portal_bytes: bytes,
                     num_agents: int,
                     num_cpus: int,
@@ -836,7 +1156,8 @@ def processar_plano(portal_bytes: bytes,
                     output_csv: bool,
                     fazer_gif: bool,
                     job_id: str,
-                    team: str):
+                    team: str,
+                    reuse_dir: str | None = None):
     jobs_root = os.path.join("data", "jobs")
     os.makedirs(jobs_root, exist_ok=True)
     outdir = os.path.join(jobs_root, job_id)
@@ -855,19 +1176,21 @@ def processar_plano(portal_bytes: bytes,
             t("INÍCIO processar_plano")
             # Removido acesso a st.session_state na thread
             print(f"[INFO] os.cpu_count()={os.cpu_count()} · cpus_eff={num_cpus} · gif={fazer_gif} · csv={output_csv} · team={team}")
-            t("Chamando run_maxfield()…")
-            run_maxfield(
-                portal_path,
-                num_agents=int(num_agents),
-                num_cpus=int(num_cpus),
-                res_colors=res_colors,
-                google_api_key=(google_api_key or None),
-                google_api_secret=(google_api_secret or None),
-                output_csv=output_csv,
-                outdir=outdir,
-                verbose=True,
-                skip_step_plots=(not fazer_gif),
-            )
+            reused = bool(reuse_dir) and _copy_plan_outputs(reuse_dir, outdir)
+            if not reused:
+                t("Chamando run_maxfield()…")
+                run_maxfield(
+                    portal_path,
+                    num_agents=int(num_agents),
+                    num_cpus=int(num_cpus),
+                    res_colors=res_colors,
+                    google_api_key=(google_api_key or None),
+                    google_api_secret=(google_api_secret or None),
+                    output_csv=output_csv,
+                    outdir=outdir,
+                    verbose=True,
+                    skip_step_plots=(not fazer_gif),
+                )
             t(f"maxfield() OK em {time.time()-t0:.1f}s")
             t1 = time.time()
             t("Compactando artefatos no ZIP…")
@@ -887,76 +1210,51 @@ def processar_plano(portal_bytes: bytes,
 
     # Cria o ZIP (agora já existe maxfield_log.txt para ser incluído)
     zip_path = os.path.join(outdir, f"maxfield_output_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip")
+    # grava direto no disco: o download lê do arquivo, nada fica em memória
     with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as z:
         for root, _, files in os.walk(outdir):
             for fn in files:
                 if fn.endswith(".zip"): continue
                 fp = os.path.join(root, fn)
                 arc = os.path.relpath(fp, outdir)
-                z.write(fp, arcname=arc)
+                ext = fn.rsplit(".", 1)[-1].lower()
+                z.write(fp, arcname=arc,
+                        compress_type=zipfile.ZIP_STORED if ext in _ZIP_STORED_EXTS else zipfile.ZIP_DEFLATED)
 
     # Acrescenta a linha final no log (no disco). A versão no ZIP já está garantida.
-    with redirect_stdout(log_buffer):
-        print(f"[{time.strftime('%H:%M:%S')}] ZIP pronto em {time.time()-t1:.1f}s; total {time.time()-t0:.1f}s")
-    log_txt = log_buffer.getvalue()
     try:
-        with open(log_path, "w", encoding="utf-8", errors="ignore") as lf:
-            lf.write(log_txt or "")
+        with open(log_path, "a", encoding="utf-8", errors="ignore") as lf:
+            lf.write(f"[{time.strftime('%H:%M:%S')}] ZIP pronto em {time.time()-t1:.1f}s; total {time.time()-t0:.1f}s\n")
     except Exception:
         pass
 
-    def read_bytes(path):
-        return open(path, "rb").read() if os.path.exists(path) else None
-
-    pm_bytes = read_bytes(os.path.join(outdir, "portal_map.png"))
-    lm_bytes = read_bytes(os.path.join(outdir, "link_map.png"))
-    gif_bytes = read_bytes(os.path.join(outdir, "plan_movie.gif"))
-
-    # mini summary salvo em arquivos (sem botões)
-    summary_md = []
-    summary_md.append(f"# Plano Maxfield — {datetime.now().strftime('%Y-%m-%d %H:%M')}")
-    summary_md.append(f"- **Job**: `{job_id}`")
-    summary_md.append(f"- **Facção**: {'Resistance (azul)' if res_colors else 'Enlightened (verde)'}")
-    summary_md.append(f"- **Agentes**: {num_agents} · **CPUs**: {num_cpus} · **CSV**: {output_csv} · **GIF**: {fazer_gif}")
-    summary_md.append(f"- **Portais**: ver `portais.txt`")
-    if os.path.exists(os.path.join(outdir, "portal_map.png")):
-        summary_md.append(f"\n![Portal Map](portal_map.png)")
-    if os.path.exists(os.path.join(outdir, "link_map.png")):
-        summary_md.append(f"\n![Link Map](link_map.png)")
-    summary_md.append("\n---\nLogs completos: `maxfield_log.txt`")
-    summary_md = "\n".join(summary_md)
-    with open(os.path.join(outdir, "summary.md"), "w", encoding="utf-8") as f:
-        f.write(summary_md)
-
-    summary_html = f"""<!doctype html><html lang="pt-br"><meta charset="utf-8">
-<title>Plano Maxfield — {job_id}</title>
-<style>body{{font-family:sans-serif;margin:24px}} img{{max-width:100%;height:auto}} h1{{margin-top:0}}</style>
-<h1>Plano Maxfield — {datetime.now().strftime('%Y-%m-%d %H:%M')}</h1>
-<p><b>Job:</b> {job_id}<br>
-<b>Facção:</b> {"Resistance (azul)" if res_colors else "Enlightened (verde)"}<br>
-<b>Agentes:</b> {num_agents} · <b>CPUs:</b> {num_cpus} · <b>CSV:</b> {output_csv} · <b>GIF:</b> {fazer_gif}</p>
-<p>Portais: ver <code>portais.txt</code></p>
-{"<h2>Portal Map</h2><img src='portal_map.png'>" if os.path.exists(os.path.join(outdir,"portal_map.png")) else ""}
-{"<h2>Link Map</h2><img src='link_map.png'>" if os.path.exists(os.path.join(outdir,"link_map.png")) else ""}
-<hr><p>Logs: <code>maxfield_log.txt</code></p>
-</html>"""
-    with open(os.path.join(outdir, "summary.html"), "w", encoding="utf-8") as f:
-        f.write(summary_html)
-
-    zip_bytes = open(zip_path, "rb").read()
+    # 1 listagem da pasta do job; as checagens abaixo viram teste de pertinência
+    with os.scandir(outdir) as it:
+        names = frozenset(e.name for e in it)
+    def existing(name):
+        return os.path.join(outdir, name) if name in names else None
 
     return {
-        "zip_bytes": zip_bytes,
-        "pm_bytes": pm_bytes,
-        "lm_bytes": lm_bytes,
-        "gif_bytes": gif_bytes,
-        "log_txt": log_txt,
+        # só caminhos: os artefatos ficam no disco e são lidos na hora de exibir/baixar
+        "pm_path": existing("portal_map.png"),
+        "lm_path": existing("link_map.png"),
+        "gif_path": existing("plan_movie.gif"),
+        "log_path": log_path,  # log fica só no disco; a UI lê o final sob demanda
         "outdir": outdir,
+        "zip_path": zip_path,
+        "reused": reused,
         "job_id": job_id
     }
 
 # ---------- UI Principal (tabs) ----------
-ENABLE_FORUM = bool(st.secrets.get("ENABLE_FORUM", True))
+# chips de facção prontos (HTML fixo; reruns só fazem lookup)
+FACTION_CHIPS = {
+    "Enlightened": '<span class="mf-chip enl">Enlightened</span>',
+    "Resistance": '<span class="mf-chip res">Resistance</span>',
+}
+FACTION_CHIPS_HTML = FACTION_CHIPS["Enlightened"] + FACTION_CHIPS["Resistance"]
+
+ENABLE_FORUM = SECRETS["ENABLE_FORUM"]
 tabs = ["🧩 Gerar plano", "🕑 Histórico", "📊 Métricas"]
 if ENABLE_FORUM:
     tabs.append("💬 Fórum (debate e melhorias)")
@@ -969,7 +1267,7 @@ tab_forum = tab_objs[3] if ENABLE_FORUM else None
 
 # ====== TAB: GERAR PLANO ======
 with tab_gen:
-    st.markdown('<span class="mf-chip enl">Enlightened</span><span class="mf-chip res">Resistance</span>', unsafe_allow_html=True)
+    st.markdown(FACTION_CHIPS_HTML, unsafe_allow_html=True)
 
     fast_mode = st.toggle("⚡ Modo rápido (desliga GIF e CSV para máxima velocidade)", value=False, key="fast_mode")
 
@@ -987,13 +1285,10 @@ with tab_gen:
 
         with st.expander("🗺️ Pré-visualização dos portais (opcional)"):
             txt_preview = txt_content or (uploaded.getvalue().decode("utf-8", errors="ignore") if uploaded else "")
-            pts = extract_points(clean_invisibles(txt_preview))
-            st.write(f"Detectados **{len(pts)}** portais para prévia.")
-            if pts:
-                import pandas as pd, pydeck as pdk
-                df = pd.DataFrame(pts)
-                mid_lat = df["lat"].mean()
-                mid_lon = df["lon"].mean()
+            df, (mid_lat, mid_lon) = _preview_points(txt_preview)
+            st.write(f"Detectados **{len(df)}** portais para prévia.")
+            if len(df):
+                import pydeck as pdk
                 layer = pdk.Layer("ScatterplotLayer", data=df, get_position='[lon, lat]', get_radius=12, pickable=True)
                 st.pydeck_chart(pdk.Deck(map_style=None,
                                          initial_view_state=pdk.ViewState(latitude=mid_lat, longitude=mid_lon, zoom=14),
@@ -1035,7 +1330,7 @@ with tab_gen:
         texto_portais = clean_invisibles(texto_portais)
 
         # limite server-side de portais
-        MAX_PORTALS_SERVER = int(st.secrets.get("MAX_PORTALS", 200))
+        MAX_PORTALS_SERVER = MAX_PORTALS
         linhas = texto_portais.splitlines()
         count = 0; kept = []
         for ln in linhas:
@@ -1066,8 +1361,8 @@ with tab_gen:
             os.environ["MAXFIELD_DISABLE_BASEMAP"] = "1"
         else:
             os.environ.pop("MAXFIELD_DISABLE_BASEMAP", None)
-            google_api_key = (google_key_input or "").strip() or st.secrets.get("GOOGLE_API_KEY", None)
-            google_api_secret = (google_api_secret_input or "").strip() or st.secrets.get("GOOGLE_API_SECRET", None)
+            google_api_key = (google_key_input or "").strip() or SECRETS["GOOGLE_API_KEY"]
+            google_api_secret = (google_api_secret_input or "").strip() or SECRETS["GOOGLE_API_SECRET"]
 
         eff_cpus = int(num_cpus)
         if eff_cpus == 0:
@@ -1103,6 +1398,27 @@ with tab_gen:
         st.rerun()
 
 # ===== UI de acompanhamento do job =====
+@_fragment(run_every=1)
+def job_progress(job_id: str):
+    # só este bloco roda a cada 1s (sem sleep segurando o script); ao concluir, rerun completo
+    job = get_job(job_id)
+    if not job or job.get("done"):
+        st.rerun()
+    elapsed = time.time() - job["t0"]
+    eta_s = job["eta"]
+    with st.status(f"⏳ Processando… (job {job_id})", expanded=True) as status:
+        pct = min(0.90, elapsed / max(1e-6, eta_s))
+        st.progress(int(pct * 100))
+        eta_left = max(0, eta_s - elapsed)
+        st.write(f"**Estimativa:** ~{int(eta_left)}s restantes · **Decorridos:** {int(elapsed)}s")
+        if st.button("🛑 Cancelar este job", key=f"cancel_{job_id}"):
+            status.update(label="🛑 Cancelando…", state="error", expanded=True)
+            fut = job.get("future")
+            if not (fut and fut.cancel()):
+                job["out"] = {"ok": False, "error": "Cancelamento solicitado (não foi possível interromper em execução)"}
+                job["done"] = True
+            st.rerun()
+
 job_id = st.session_state.get("job_id")
 if job_id:
     job = get_job(job_id)
@@ -1115,135 +1431,57 @@ if job_id:
             if out.get("ok"):
                 res = out["result"]
                 st.session_state["last_result"] = res
-                inc_metric("plans_completed", 1)
-                try:
-                    record_run(
-                        int(job.get("meta", {}).get("n_portais", 0)),
-                        int(job.get("meta", {}).get("num_cpus", 0)),
-                        bool(job.get("meta", {}).get("gif", False)),
-                        float(out.get("elapsed", 0.0)),
-                    )
-                    add_job_row(
-                        job_id=out.get("job_id", job_id),
-                        uid=UID,
-                        n_portais=int(job.get("meta", {}).get("n_portais", 0)),
-                        num_cpus=int(job.get("meta", {}).get("num_cpus", 0)),
-                        team=str(job.get("meta", {}).get("team","")),
-                        output_csv=bool(job.get("meta", {}).get("output_csv", True)),
-                        fazer_gif=bool(job.get("meta", {}).get("gif", False)),
-                        dur_s=float(out.get("elapsed", 0.0)),
-                        out_dir=str(res.get("outdir",""))
-                    )
-                except Exception:
-                    pass
+                detach_job_result(job)
+                finish_job(job_id, job, out, res, UID)
             else:
                 st.error(f"Erro ao gerar o plano: {out.get('error','desconhecido')}")
             del st.session_state["job_id"]
             qp_set(job=None)
         else:
-            fut = job["future"]
-            t0 = job["t0"]
-            eta_s = job["eta"]
-            canceled = False
-            with st.status(f"⏳ Processando… (job {job_id})", expanded=True) as status:
-                bar = st.progress(0)
-                eta_ph = st.empty()
-                cancel_ph = st.empty()
-                if cancel_ph.button("🛑 Cancelar este job", key=f"cancel_{job_id}"):
-                    canceled = True
-                    try:
-                        fut.cancel()
-                        status.update(label="🛑 Cancelando…", state="error", expanded=True)
-                    except Exception:
-                        pass
-
-                while not fut.done():
-                    if canceled:
-                        break
-                    elapsed = time.time() - t0
-                    pct = min(0.90, elapsed / max(1e-6, eta_s))
-                    bar.progress(int(pct * 100))
-                    eta_left = max(0, eta_s - elapsed)
-                    eta_ph.write(f"**Estimativa:** ~{int(eta_left)}s restantes · **Decorridos:** {int(elapsed)}s")
-                    time.sleep(0.3)
-
-            if canceled:
-                if fut.cancelled():
-                    job["done"] = True
-                    job["out"] = {"ok": False, "error": "Job cancelado pelo usuário"}
-                else:
-                    job["done"] = True
-                    job["out"] = {"ok": False, "error": "Cancelamento solicitado (não foi possível interromper em execução)"}
-                del st.session_state["job_id"]
-                qp_set(job=None)
-                st.stop()
-
-            out = fut.result()
-            bar.progress(100)
-            job["done"] = True
-            job["out"] = out
-            if out.get("ok"):
-                status.update(label="✅ Concluído", state="complete", expanded=False)
-                res = out["result"]
-                st.session_state["last_result"] = res
-                inc_metric("plans_completed", 1)
-                try:
-                    record_run(
-                        int(job.get("meta", {}).get("n_portais", 0)),
-                        int(job.get("meta", {}).get("num_cpus", 0)),
-                        bool(job.get("meta", {}).get("gif", False)),
-                        float(out.get("elapsed", 0.0)),
-                    )
-                    add_job_row(
-                        job_id=out.get("job_id", job_id),
-                        uid=UID,
-                        n_portais=int(job.get("meta", {}).get("n_portais", 0)),
-                        num_cpus=int(job.get("meta", {}).get("num_cpus", 0)),
-                        team=str(job.get("meta", {}).get("team","")),
-                        output_csv=bool(job.get("meta", {}).get("output_csv", True)),
-                        fazer_gif=bool(job.get("meta", {}).get("gif", False)),
-                        dur_s=float(out.get("elapsed", 0.0)),
-                        out_dir=str(res.get("outdir",""))
-                    )
-                except Exception:
-                    pass
-            else:
-                status.update(label="❌ Falhou", state="error", expanded=True)
-                st.error(f"Erro ao gerar o plano: {out.get('error','desconhecido')}")
-            del st.session_state["job_id"]
-            qp_set(job=None)
+            job_progress(job_id)
 
 # ===== Render de resultados persistentes =====
+LOG_TAIL_BYTES = 20000
+
 res = st.session_state.get("last_result")
 if res:
     st.success("Plano gerado com sucesso!")
-    if res.get("pm_bytes"):
-        st.image(res["pm_bytes"], caption="Portal Map")
-    if res.get("lm_bytes"):
-        st.image(res["lm_bytes"], caption="Link Map")
-    if res.get("gif_bytes"):
-        st.download_button(
-            "Baixar GIF (plan_movie.gif)",
-            data=res["gif_bytes"],
-            file_name="plan_movie.gif",
-            mime="image/gif",
-            key="dl_gif_last",
-        )
-    st.download_button(
-        "Baixar todos os arquivos (.zip)",
-        data=res["zip_bytes"],
-        file_name=f"maxfield_output_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
-        mime="application/zip",
-        key="dl_zip_last",
-    )
+    # artefatos vêm do disco (podem ter sido limpos pelo housekeeping)
+    def _have(key): return bool(res.get(key)) and os.path.exists(res[key])
+    if _have("pm_path"):
+        st.image(res["pm_path"], caption="Portal Map")
+    if _have("lm_path"):
+        st.image(res["lm_path"], caption="Link Map")
+    if _have("gif_path"):
+        with open(res["gif_path"], "rb") as fh:
+            st.download_button(
+                "Baixar GIF (plan_movie.gif)",
+                data=fh,
+                file_name="plan_movie.gif",
+                mime="image/gif",
+                key="dl_gif_last",
+            )
+    if _have("zip_path"):
+        with open(res["zip_path"], "rb") as fh:
+            st.download_button(
+                "Baixar todos os arquivos (.zip)",
+                data=fh,
+                file_name=os.path.basename(res["zip_path"]),
+                mime="application/zip",
+                key="dl_zip_last",
+            )
     with st.expander("Ver logs do processamento"):
-        log_txt_full = res.get("log_txt") or "(sem logs)"
-        if len(log_txt_full) > 20000:
-            st.caption("Log truncado (últimos ~20k caracteres).")
-            log_txt = log_txt_full[-20000:]
-        else:
-            log_txt = log_txt_full
-        st.code(log_txt, language="bash")
+        log_txt = ""
+        try:
+            with open(res.get("log_path") or "", "rb") as lf:
+                size = os.fstat(lf.fileno()).st_size
+                if size > LOG_TAIL_BYTES:
+                    st.caption("Log truncado (últimos ~20k caracteres).")
+                    lf.seek(size - LOG_TAIL_BYTES)
+                log_txt = lf.read().decode("utf-8", errors="ignore")
+        except OSError:
+            pass
+        st.code(log_txt or "(sem logs)", language="bash")
     if st.button("🧹 Limpar resultados", key="clear_res"):
         st.session_state.pop("last_result", None)
         qp_set(job=None)
@@ -1251,9 +1489,8 @@ if res:
 
 # ---------- MÉTRICAS ----------
 with tab_metrics:
-    conn = get_db()
-    cur = conn.execute("SELECT ts, n_portais, num_cpus, gif, dur_s FROM runs ORDER BY ts DESC LIMIT 100")
-    data = cur.fetchall()
+    with db_conn() as conn:
+        data = conn.execute("SELECT ts, n_portais, num_cpus, gif, dur_s FROM runs ORDER BY ts DESC LIMIT 100").fetchall()
     if not data:
         st.info("Ainda sem dados suficientes para métricas.")
     else:
@@ -1268,12 +1505,14 @@ with tab_metrics:
         st.caption("Barras (da mais antiga para a mais recente) mostram a duração por execução.")
 
 # ===================== FORUM / LOGIN =====================
-import hashlib
+import hmac
 
-ADMIN_CODE = st.secrets.get("ADMIN_CODE", "")
-COMMENTS_ENABLED = bool(st.secrets.get("COMMENTS_ENABLED", True))
-MAX_IMG_MB = int(st.secrets.get("MAX_IMG_MB", 2))
-MAX_IMGS_PER_POST = int(st.secrets.get("MAX_IMGS_PER_POST", 3))
+ADMIN_CODE = SECRETS["ADMIN_CODE"]
+COMMENTS_ENABLED = SECRETS["COMMENTS_ENABLED"]
+MAX_IMG_MB = SECRETS["MAX_IMG_MB"]
+MAX_IMGS_PER_POST = SECRETS["MAX_IMGS_PER_POST"]
+FORUM_PAGE_SIZE = 10     # tópicos por página em cada categoria
+COMMENTS_PAGE_SIZE = 20  # comentários por "Carregar mais"
 
 def _now_ts() -> int:
     return int(time.time())
@@ -1295,25 +1534,54 @@ def save_avatar_file(user_id: int, avatar_bytes: bytes|None, avatar_ext: str|Non
     try:
         with open(av_path, "wb") as f:
             f.write(avatar_bytes)
-        conn = get_db()
-        conn.execute("UPDATE users SET avatar_ext=? WHERE id=?", (safe_ext, int(user_id)))
-        conn.commit()
+        with db_conn() as conn:
+            conn.execute("UPDATE users SET avatar_ext=? WHERE id=?", (safe_ext, int(user_id)))
+        get_user_avatar_ext.clear()
         return safe_ext
     except Exception:
         return None
 
+# SQL fixo em constantes: a mesma string a cada chamada acerta o cache de statements do sqlite3
+SQL_USER_BY_USERNAME = """
+    SELECT id, username, username_lc, pass_hash, faction, email, avatar_ext, is_admin, pass_salt
+      FROM users
+     WHERE username_lc = ?
+     LIMIT 1
+"""
+SQL_USER_BY_EMAIL = """
+    SELECT id, username, username_lc, pass_hash, faction, email, avatar_ext, is_admin, pass_salt
+      FROM users
+     WHERE email = ?
+     LIMIT 1
+"""
+SQL_USER_BY_TOKEN = """
+    SELECT u.id, u.username, u.username_lc, u.faction, u.email, u.avatar_ext, u.is_admin
+      FROM sessions s JOIN users u ON u.id=s.user_id
+     WHERE s.token=? LIMIT 1
+"""
+SQL_TOUCH_SESSION = "UPDATE sessions SET last_seen_ts=? WHERE token=?"
+SQL_USER_PASS_BY_ID = "SELECT pass_hash, pass_salt FROM users WHERE id=?"
+SQL_USER_AVATAR_EXT = "SELECT avatar_ext FROM users WHERE id=?"
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_user_avatar_ext(user_id:int) -> str|None:
+    # autores se repetem entre posts/comentários: 1 consulta por usuário por minuto
+    with db_conn() as conn:
+        row = conn.execute(SQL_USER_AVATAR_EXT, (int(user_id),)).fetchone()
+    return row[0] if row else None
+
 def get_user_by_username_or_email(identifier: str):
     if not identifier:
         return None
     ident = identifier.strip()
-    conn = get_db()
-    cur = conn.execute("""
-        SELECT id, username, username_lc, pass_hash, faction, email, avatar_ext, is_admin, pass_salt
-          FROM users
-         WHERE username_lc = ? OR email = ?
-         LIMIT 1
-    """, (ident.lower(), ident))
-    row = cur.fetchone()
+    row = None
+    with db_conn() as conn:
+        if "@" in ident:
+            # cada forma de login vira 1 busca por índice (um OR entre colunas pode cair em scan)
+            row = conn.execute(SQL_USER_BY_EMAIL, (ident,)).fetchone()
+        if not row:
+            # username sem validação de caracteres: "@" ainda pode ser nome de usuário
+            row = conn.execute(SQL_USER_BY_USERNAME, (ident.lower(),)).fetchone()
     if not row:
         return None
     return {
@@ -1328,13 +1596,19 @@ def get_user_by_username_or_email(identifier: str):
         "pass_salt": row[8] or "",
     }
 
+SQL_INSERT_USER_IF_FREE = """
+    INSERT INTO users (username, username_lc, pass_hash, pass_salt, faction, email, avatar_ext, is_admin, created_ts, updated_ts)
+    SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+    WHERE NOT EXISTS (SELECT 1 FROM users WHERE username_lc=?)
+"""
+
 def create_user(username: str,
                 password: str,
                 faction: str,
                 email: str|None,
                 is_admin_bool: bool,
                 avatar_bytes: bytes|None,
-                avatar_ext: str|None) -> int:
+                avatar_ext: str|None) -> dict:
     if not username or not password:
         raise ValueError("username e password são obrigatórios")
 
@@ -1345,66 +1619,68 @@ def create_user(username: str,
     is_admin = 1 if is_admin_bool else 0
     ts = _now_ts()
 
-    salt = uuid.uuid4().hex[:8]
+    salt = _short_id()
     p_hash = hash_pass(password, salt)
 
-    conn = get_db()
-    cur = conn.execute("SELECT 1 FROM users WHERE username_lc=?", (uname_lc,))
-    if cur.fetchone():
+    # checagem de nome + INSERT num único statement (sonda no índice de username_lc);
+    # a IntegrityError cobre a corrida entre dois cadastros simultâneos
+    try:
+        with db_conn() as conn:
+            cur = conn.execute(SQL_INSERT_USER_IF_FREE,
+                               (uname, uname_lc, p_hash, salt, fac, mail, None, is_admin, ts, ts, uname_lc))
+    except sqlite3.IntegrityError:
         raise ValueError("Este nome de usuário já está em uso.")
-
-    conn.execute("""
-        INSERT INTO users (username, username_lc, pass_hash, pass_salt, faction, email, avatar_ext, is_admin, created_ts, updated_ts)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (uname, uname_lc, p_hash, salt, fac, mail, None, int(is_admin), ts, ts))
-    conn.commit()
-
-    cur = conn.execute("SELECT id FROM users WHERE username_lc=?", (uname_lc,))
-    row = cur.fetchone()
-    if not row:
+    if cur.rowcount == 0:
+        raise ValueError("Este nome de usuário já está em uso.")
+    user_id = cur.lastrowid
+    if not user_id:
         raise RuntimeError("Falha ao criar usuário.")
-    user_id = int(row[0])
 
+    saved_ext = None
     if avatar_bytes and avatar_ext:
-        save_avatar_file(user_id, avatar_bytes, avatar_ext)
+        saved_ext = save_avatar_file(user_id, avatar_bytes, avatar_ext)
 
-    return user_id
+    # mesmo formato de get_user_by_token, montado com o que acabou de ser gravado
+    return {
+        "id": int(user_id),
+        "username": uname,
+        "username_lc": uname_lc,
+        "faction": fac,
+        "email": mail or "",
+        "avatar_ext": saved_ext,
+        "is_admin": is_admin,
+    }
 
 def check_password(user_row: dict, password: str) -> bool:
     if not user_row or not password:
         return False
-    conn = get_db()
-    cur = conn.execute("SELECT pass_hash, pass_salt FROM users WHERE id=?", (int(user_row["id"]),))
-    row = cur.fetchone()
-    if not row:
-        return False
-    ph, psalt = row[0] or "", (row[1] or "")
+    if "pass_hash" in user_row:
+        # a busca do login já trouxe hash e salt: sem 2ª ida ao banco
+        ph, psalt = user_row["pass_hash"] or "", user_row.get("pass_salt") or ""
+    else:
+        with db_conn() as conn:
+            row = conn.execute(SQL_USER_PASS_BY_ID, (int(user_row["id"]),)).fetchone()
+        if not row:
+            return False
+        ph, psalt = row[0] or "", (row[1] or "")
     if psalt:
-        return hash_pass(password, psalt) == ph
-    import hashlib as _h
-    return _h.sha256(password.encode("utf-8","ignore")).hexdigest() == ph
+        return hmac.compare_digest(hash_pass(password, psalt), ph)
+    return hmac.compare_digest(hashlib.sha256(password.encode("utf-8","ignore")).hexdigest(), ph)
 
 def create_session(user_id:int) -> str:
-    token = uuid.uuid4().hex
+    token = secrets.token_urlsafe(24)
     ts = _now_ts()
-    conn = get_db()
-    conn.execute("INSERT OR REPLACE INTO sessions(token,user_id,created_ts,last_seen_ts) VALUES(?,?,?,?)",
-                 (token, int(user_id), ts, ts))
-    conn.commit()
+    with db_conn() as conn:
+        conn.execute("INSERT OR REPLACE INTO sessions(token,user_id,created_ts,last_seen_ts) VALUES(?,?,?,?)",
+                     (token, int(user_id), ts, ts))
     return token
 
 def get_user_by_token(token:str):
-    conn = get_db()
-    cur = conn.execute("""
-        SELECT u.id, u.username, u.username_lc, u.faction, u.email, u.avatar_ext, u.is_admin
-          FROM sessions s JOIN users u ON u.id=s.user_id
-         WHERE s.token=? LIMIT 1
-    """, (token,))
-    row = cur.fetchone()
-    if not row:
-        return None
-    conn.execute("UPDATE sessions SET last_seen_ts=? WHERE token=?", (_now_ts(), token))
-    conn.commit()
+    with db_conn() as conn:
+        row = conn.execute(SQL_USER_BY_TOKEN, (token,)).fetchone()
+        if not row:
+            return None
+        conn.execute(SQL_TOUCH_SESSION, (_now_ts(), token))
     return {
         "id": int(row[0]),
         "username": row[1] or "",
@@ -1418,8 +1694,8 @@ def get_user_by_token(token:str):
 def signout_current():
     token = qp_get("token","")
     if token:
-        get_db().execute("DELETE FROM sessions WHERE token=?", (token,))
-        get_db().commit()
+        with db_conn() as conn:
+            conn.execute("DELETE FROM sessions WHERE token=?", (token,))
     st.session_state.pop("user", None)
     qp_set(token=None)
     try: st.toast("Você saiu.")
@@ -1430,108 +1706,335 @@ def current_user():
     if "user" in st.session_state and st.session_state["user"]:
         return st.session_state["user"]
     token = qp_get("token","")
-    if token:
+    # token já recusado nesta sessão (expirado/removido): não volta ao banco a cada rerun
+    if token and token != st.session_state.get("bad_token"):
         u = get_user_by_token(token)
         if u:
             st.session_state["user"] = u
             return u
+        st.session_state["bad_token"] = token
     return None
 
-def forum_count_comments(post_id:int) -> int:
-    cur = get_db().execute("SELECT COUNT(*) FROM forum_comments WHERE post_id=? AND (deleted_ts IS NULL)", (int(post_id),))
-    return int(cur.fetchone()[0])
+@st.cache_resource(show_spinner=False)
+def _io_pool():
+    return ThreadPoolExecutor(max_workers=2)
 
-def forum_create_post(cat:str, title:str, body_md:str, images, author:dict) -> int:
-    ts = _now_ts()
-    conn = get_db()
-    conn.execute("""
-        INSERT INTO forum_posts(cat,title,body_md,author_id,author_name,author_faction,created_ts,updated_ts,images_json,is_pinned)
-        VALUES(?,?,?,?,?,?,?,?,?,0)
-    """, (cat, title.strip(), body_md.strip(), int(author["id"]), author["username"], author["faction"], ts, ts, "[]"))
-    conn.commit()
-    cur = conn.execute("SELECT id FROM forum_posts WHERE author_id=? ORDER BY id DESC LIMIT 1", (int(author["id"]),))
-    row = cur.fetchone()
-    post_id = int(row[0])
+def _encode_post_image(data: bytes, ext: str) -> tuple[str, bytes]:
+    # reencoda em WebP (bem menor que PNG); se o PIL não abrir, mantém bytes e extensão originais
+    try:
+        from PIL import Image, ImageOps
+        with Image.open(io.BytesIO(data)) as im:
+            # WebP sai sem EXIF: aplica a rotação da câmera antes, senão foto em pé aparece deitada
+            im = ImageOps.exif_transpose(im)
+            if im.mode not in ("RGB", "RGBA"):
+                im = im.convert("RGBA" if "A" in im.getbands() else "RGB")
+            out = io.BytesIO()
+            im.save(out, "WEBP", quality=85, method=4)
+        return ".webp", out.getvalue()
+    except Exception:
+        return ext, data
 
-    saved = []
-    if images:
+def _write_post_image(path: str, data: bytes):
+    tmp = path + ".part"
+    with open(tmp, "wb") as out:
+        out.write(data)
+    os.replace(tmp, path)  # a listagem nunca vê arquivo pela metade
+
+def forum_create_post(cat:str, title:str, body_md:str, images, author:dict) -> tuple[int, list[str]]:
+    # retorna (id do post, anexos que não puderam ser gravados)
+    ts = _now_ts()
+    # conversões p/ WebP em paralelo; esperadas antes do INSERT, pois a extensão final entra no images_json
+    jobs = []
+    for i, f in enumerate((images or [])[:MAX_IMGS_PER_POST], start=1):
+        data = f.getvalue()
+        if len(data) > MAX_IMG_MB*1024*1024:
+            continue
+        ext = os.path.splitext(getattr(f, "name", ""))[1].lower() or ".bin"
+        jobs.append((i, _io_pool().submit(_encode_post_image, data, ext)))
+    blobs = []
+    for i, fut in jobs:
+        ext, data = fut.result()
+        blobs.append((f"img{i}{ext}", data))
+    with db_conn() as conn:
+        cur = conn.execute("""
+            INSERT INTO forum_posts(cat,title,body_md,author_id,author_name,author_faction,created_ts,updated_ts,images_json,is_pinned)
+            VALUES(?,?,?,?,?,?,?,?,?,0)
+        """, (cat, title.strip(), body_md.strip(), int(author["id"]), author["username"], author["faction"], ts, ts,
+              json.dumps([name for name, _ in blobs])))
+    post_id = int(cur.lastrowid)
+
+    # gravação síncrona (bytes já prontos): o rerun do autor já encontra os arquivos
+    failed = []
+    if blobs:
         root = os.path.join("data","posts",str(post_id))
-        os.makedirs(root, exist_ok=True)
-        for i, f in enumerate(images[:MAX_IMGS_PER_POST], start=1):
-            data = f.getvalue()
-            if len(data) > MAX_IMG_MB*1024*1024:
-                continue
-            name = f.name.lower()
-            ext = ".png"
-            for e in (".png",".jpg",".jpeg",".webp"):
-                if name.endswith(e):
-                    ext = e; break
-            p = os.path.join(root, f"img{i}{ext}")
-            with open(p,"wb") as out:
-                out.write(data)
-            saved.append(os.path.basename(p))
-    conn.execute("UPDATE forum_posts SET images_json=? WHERE id=?", (json.dumps(saved), post_id))
-    conn.commit()
-    return post_id
-
-def forum_list_posts(cat:str):
-    cur = get_db().execute("""
-        SELECT id, title, author_name, author_faction, created_ts, images_json, author_id
-          FROM forum_posts
-         WHERE cat=?
-         ORDER BY is_pinned DESC, created_ts DESC
-    """, (cat,))
-    return cur.fetchall()
-
-def forum_get_post(post_id:int):
-    cur = get_db().execute("""
-        SELECT id, cat, title, body_md, author_id, author_name, author_faction, created_ts, images_json
-          FROM forum_posts WHERE id=? LIMIT 1
-    """, (int(post_id),))
-    return cur.fetchone()
+        for name, data in blobs:
+            try:
+                os.makedirs(root, exist_ok=True)
+                _write_post_image(os.path.join(root, name), data)
+            except OSError:
+                failed.append(name)
+        if failed:
+            with db_conn() as conn:
+                conn.execute("UPDATE forum_posts SET images_json=? WHERE id=?",
+                             (json.dumps([name for name, _ in blobs if name not in failed]), post_id))
+    return post_id, failed
+
+# avatar do autor vem no mesmo JOIN (PK de users); n_comments já é contador desnormalizado;
+# corpo vem junto: a página inteira sai numa query só
+SQL_FORUM_LIST_POSTS = """
+    SELECT p.id, p.title, p.author_name, p.author_faction, p.created_ts, p.images_json,
+           p.author_id, p.n_comments, u.avatar_ext, p.body_md
+      FROM forum_posts p
+      LEFT JOIN users u ON u.id = p.author_id
+     WHERE p.cat=?
+     ORDER BY p.is_pinned DESC, p.created_ts DESC
+     LIMIT ? OFFSET ?
+"""
+SQL_FORUM_INSERT_COMMENT = """
+    INSERT INTO forum_comments(post_id,author_id,author_name,author_faction,body_md,created_ts,deleted_ts)
+    VALUES(?,?,?,?,?,?,NULL)
+"""
+SQL_FORUM_LIST_COMMENTS = """
+    SELECT id, author_id, author_name, author_faction, body_md, created_ts, deleted_ts
+      FROM forum_comments
+     WHERE post_id=?
+     ORDER BY created_ts ASC
+     LIMIT ?
+"""
+
+def forum_list_posts(cat:str, limit:int=FORUM_PAGE_SIZE, offset:int=0):
+    with db_conn() as conn:
+        return conn.execute(SQL_FORUM_LIST_POSTS, (cat, int(limit), int(offset))).fetchall()
+
+def forum_add_comments(rows):
+    # rows: (post_id, author_id, author_name, author_faction, body_md, created_ts); 1 transação p/ o lote
+    rows = list(rows)
+    with db_tx() as conn:
+        conn.executemany(SQL_FORUM_INSERT_COMMENT, rows)
+        conn.executemany("UPDATE forum_posts SET n_comments = n_comments + 1 WHERE id=?",
+                         [(r[0],) for r in rows])
+    forum_list_comments.clear()
 
 def forum_add_comment(post_id:int, author:dict, body_md:str):
-    ts = _now_ts()
-    get_db().execute("""
-        INSERT INTO forum_comments(post_id,author_id,author_name,author_faction,body_md,created_ts,deleted_ts)
-        VALUES(?,?,?,?,?,?,NULL)
-    """, (int(post_id), int(author["id"]), author["username"], author["faction"], body_md.strip(), ts))
-    get_db().commit()
-
-def forum_list_comments(post_id:int):
-    cur = get_db().execute("""
-        SELECT id, author_id, author_name, author_faction, body_md, created_ts, deleted_ts
-          FROM forum_comments
-         WHERE post_id=?
-         ORDER BY created_ts ASC
-    """, (int(post_id),))
-    return cur.fetchall()
+    forum_add_comments([(int(post_id), int(author["id"]), author["username"], author["faction"], body_md.strip(), _now_ts())])
+
+@st.cache_data(ttl=15, show_spinner=False)
+def forum_list_comments(post_id:int, limit:int=COMMENTS_PAGE_SIZE):
+    with db_conn() as conn:
+        return conn.execute(SQL_FORUM_LIST_COMMENTS, (int(post_id), int(limit))).fetchall()
 
 def forum_delete_comment(comment_id:int):
-    get_db().execute("UPDATE forum_comments SET deleted_ts=? WHERE id=?", (_now_ts(), int(comment_id)))
-    get_db().commit()
+    with db_tx() as conn:
+        cur = conn.execute("UPDATE forum_comments SET deleted_ts=? WHERE id=? AND deleted_ts IS NULL",
+                           (_now_ts(), int(comment_id)))
+        if cur.rowcount:
+            conn.execute("""
+                UPDATE forum_posts SET n_comments = MAX(0, n_comments - 1)
+                 WHERE id = (SELECT post_id FROM forum_comments WHERE id=?)
+            """, (int(comment_id),))
+    forum_list_comments.clear()
+
+def forum_comment_count(post_id:int) -> int:
+    with db_conn() as conn:
+        row = conn.execute("SELECT n_comments FROM forum_posts WHERE id=?", (int(post_id),)).fetchone()
+    return int(row[0]) if row else 0
 
 def forum_update_post(post_id:int, title:str, body_md:str):
-    get_db().execute(
-        "UPDATE forum_posts SET title=?, body_md=?, updated_ts=? WHERE id=?",
-        (title.strip(), body_md.strip(), _now_ts(), int(post_id))
-    )
-    get_db().commit()
+    with db_conn() as conn:
+        conn.execute(
+            "UPDATE forum_posts SET title=?, body_md=?, updated_ts=? WHERE id=?",
+            (title.strip(), body_md.strip(), _now_ts(), int(post_id))
+        )
+
+@st.cache_data(ttl=20, show_spinner=False)
+def forum_activity_marker():
+    # retrato barato do fórum: muda quando há post/comentário novo, editado ou apagado
+    with db_conn() as conn:
+        row = conn.execute("""
+            SELECT (SELECT COUNT(*) FROM forum_posts),
+                   (SELECT MAX(updated_ts) FROM forum_posts),
+                   (SELECT COUNT(*) FROM forum_comments),
+                   (SELECT MAX(created_ts) FROM forum_comments),
+                   (SELECT MAX(deleted_ts) FROM forum_comments)
+        """).fetchone()
+    return tuple(row)
+
+@_fragment(run_every=20)
+def forum_auto_refresh():
+    # roda sozinho a cada 20s; só refaz a página inteira se o fórum mudou
+    marker = forum_activity_marker()
+    last = st.session_state.get("forum_marker")
+    st.session_state["forum_marker"] = marker
+    if last is not None and last != marker:
+        st.rerun()
+
+@functools.lru_cache(maxsize=512)
+def _avatar_data_uri(path: str, mtime: float) -> str:
+    # mtime entra na chave: trocar o avatar invalida a entrada antiga
+    mime = mimetypes.guess_type(path)[0] or "image/png"
+    with open(path, "rb") as f:
+        return f"data:{mime};base64,{base64.b64encode(f.read()).decode('ascii')}"
 
-def user_avatar_bytes(user_id:int, avatar_ext:str|None):
+def user_avatar_uri(user_id:int, avatar_ext:str|None):
     if not avatar_ext: return None
     p = os.path.join("data","avatars",str(user_id), f"avatar{avatar_ext}")
-    if os.path.exists(p):
-        try: return open(p,"rb").read()
-        except: return None
-    return None
+    try: return _avatar_data_uri(p, os.stat(p).st_mtime)  # um único stat: existência + mtime
+    except OSError: return None
+
+@functools.lru_cache(maxsize=4096)
+def _fmt_ts(ts:int) -> str:
+    # datas de posts/comentários não mudam: formata uma vez por timestamp
+    return datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M")
+
+def avatar_html(uri:str, width:int) -> str:
+    return f"<img src='{uri}' class='mf-avatar' width='{width}'>"
+
+@_fragment
+def render_post_card(pid, title, body_md, images_json, author_name, author_faction, cts, author_id, cnt, av_ext, u):
+    # cada cartão é um fragmento: comentar/abrir comentários refaz só este cartão, não a página
+    av_uri = user_avatar_uri(author_id, av_ext)
+    # contagem relida após comentar/apagar aqui; vale enquanto a lista da página não trouxer outra
+    cnt_page = cnt
+    cnt_fresh = st.session_state.get(f"ccount_{pid}")
+    if cnt_fresh and cnt_fresh[0] == cnt_page:
+        cnt = cnt_fresh[1]
+    can_edit_post = u and (u.get("is_admin",0)==1 or int(u["id"])==int(author_id))
+
+    with st.container(border=True):
+        head_cols = st.columns([0.10, 0.60, 0.30])
+        with head_cols[0]:
+            if av_uri:
+                st.markdown(avatar_html(av_uri, 48), unsafe_allow_html=True)
+        with head_cols[1]:
+            dt = _fmt_ts(cts)
+            st.markdown(f"**{title}**  <span class='mf-badge'>{cnt} comentários</span><br><small>por {author_name} · {author_faction} · {dt}</small>", unsafe_allow_html=True)
+        with head_cols[2]:
+            colb1, colb2 = st.columns([1, 1], gap="small")
+            with colb1:
+                if can_edit_post:
+                    if st.button("Editar", key=f"edit_post_btn_{pid}", use_container_width=True):
+                        st.session_state[f"edit_open_{pid}"] = True
+                        _rerun_fragment()
+            with colb2:
+                if can_edit_post:
+                    if st.button("Apagar", key=f"del_post_{pid}", use_container_width=True):
+                        with db_tx() as conn:
+                            conn.execute("DELETE FROM forum_posts WHERE id=?", (int(pid),))
+                            conn.execute("DELETE FROM forum_comments WHERE post_id=?", (int(pid),))
+                        forum_list_comments.clear()
+                        st.success("Tópico removido.")
+                        st.experimental_rerun()
+
+        if body_md:
+            st.markdown(body_md)
+        try:
+            imgs = json.loads(images_json or "[]")
+        except:
+            imgs = []
+        if imgs:
+            st.caption("Imagens:")
+            ig_cols = st.columns(min(3,len(imgs)))
+            root = os.path.join("data","posts",str(pid))
+            # 1 scandir p/ a pasta do post em vez de 1 stat por imagem;
+            # st.image recebe o caminho e lê o arquivo ele mesmo
+            try:
+                with os.scandir(root) as it:
+                    present = {e.name for e in it}
+            except FileNotFoundError:
+                present = set()
+            for i, name in enumerate(imgs):
+                if name in present:
+                    with ig_cols[i % len(ig_cols)]:
+                        st.image(os.path.join(root, name))
+
+        if can_edit_post and st.session_state.get(f"edit_open_{pid}", False):
+            with st.container(border=True):
+                st.markdown("#### Editar tópico")
+                et_title = st.text_input("Título", value=title, key=f"et_title_{pid}")
+                et_body  = st.text_area("Conteúdo (Markdown)", value=body_md or "", height=140, key=f"et_body_{pid}")
+                c1, c2 = st.columns([0.2,0.2])
+                save_clicked   = c1.button("Salvar",   key=f"et_save_{pid}")
+                cancel_clicked = c2.button("Cancelar", key=f"et_cancel_{pid}")
+                if save_clicked:
+                    new_title = et_title.strip() or title
+                    forum_update_post(pid, new_title, et_body or "")
+                    st.session_state.pop(f"et_title_{pid}", None)
+                    st.session_state.pop(f"et_body_{pid}", None)
+                    st.session_state[f"edit_open_{pid}"] = False
+                    st.toast("Tópico atualizado!")
+                    st.experimental_rerun()
+                if cancel_clicked:
+                    st.session_state.pop(f"et_title_{pid}", None)
+                    st.session_state.pop(f"et_body_{pid}", None)
+                    st.session_state[f"edit_open_{pid}"] = False
+                    _rerun_fragment()
+
+        if COMMENTS_ENABLED:
+            # toggle em vez de expander: o corpo do expander roda mesmo fechado,
+            # aqui os comentários só são buscados/renderizados quando abertos.
+            # rótulo fixo: com a contagem no rótulo o widget mudaria de id e fecharia
+            if st.toggle("💬 Ver comentários", key=f"showc_{pid}"):
+                climit_key = f"climit_{pid}"
+                climit = st.session_state.get(climit_key, COMMENTS_PAGE_SIZE)
+                comms = forum_list_comments(pid, climit + 1)
+                more_comms = len(comms) > climit
+                comms = comms[:climit]
+                if not comms:
+                    st.caption("Seja o primeiro a comentar.")
+                else:
+                    for (cid, caid, caname, cafac, cbody, ctime, cdel) in comms:
+                        if cdel:
+                            st.caption("_comentário removido_")
+                            continue
+                        row_cols = st.columns([0.1,0.9])
+                        with row_cols[0]:
+                            cav_uri = user_avatar_uri(caid, get_user_avatar_ext(int(caid)))
+                            if cav_uri:
+                                st.markdown(avatar_html(cav_uri, 40), unsafe_allow_html=True)
+                        with row_cols[1]:
+                            line = f"**{caname}** · {cafac} · {_fmt_ts(ctime)}"
+                            st.markdown(line)
+                            if cbody:
+                                st.markdown(cbody)
+                            if u and (u.get("is_admin",0)==1 or int(u["id"])==int(caid)):
+                                if st.button("🗑️ Apagar", key=f"delc_{cid}"):
+                                    forum_delete_comment(cid)
+                                    st.session_state[f"ccount_{pid}"] = cnt_page, forum_comment_count(pid)
+                                    st.success("Comentário apagado.")
+                                    _rerun_fragment()
+                    if more_comms and st.button("Carregar mais", key=f"more_c_{pid}"):
+                        st.session_state[climit_key] = climit + COMMENTS_PAGE_SIZE
+                        _rerun_fragment()
+
+                if u:
+                    nonce_key_c = f"comment_nonce_{pid}"
+                    if nonce_key_c not in st.session_state:
+                        st.session_state[nonce_key_c] = 0
+                    nc = st.text_area(
+                        "Escreva um comentário",
+                        key=f"nc_{pid}_{st.session_state[nonce_key_c]}",
+                        height=100
+                    )
+                    if st.button("Comentar", key=f"btn_nc_{pid}"):
+                        if not (nc or "").strip():
+                            st.error("O comentário está vazio.")
+                        else:
+                            forum_add_comment(pid, u, nc)
+                            st.session_state[f"ccount_{pid}"] = cnt_page, forum_comment_count(pid)
+                            st.session_state[nonce_key_c] += 1
+                            st.toast("Comentário enviado!")
+                            _rerun_fragment()
+                else:
+                    st.caption("_Entre para comentar._")
+        else:
+            st.caption("_Comentários desabilitados._")
 
 # ---- Fórum UI ----
 if tab_forum is not None:
     with tab_forum:
         auto = st.toggle("🔄 Auto-atualizar a cada 20s", value=False, key="forum_auto")
         if auto:
-            st.markdown("<script>setTimeout(()=>location.reload(),20000)</script>", unsafe_allow_html=True)
+            forum_auto_refresh()
 
         u = current_user()
 
@@ -1580,8 +2083,7 @@ if tab_forum is not None:
                                 elif n.endswith(".webp"): av_ext=".webp"
                                 else: av_ext=None
                             try:
-                                uid_new = create_user(su_user, su_pass, su_faction, (su_email or "").strip() or None, is_admin, av_bytes, av_ext)
-                                usr = get_user_by_username_or_email(su_user)
+                                usr = create_user(su_user, su_pass, su_faction, (su_email or "").strip() or None, is_admin, av_bytes, av_ext)
                                 token = create_session(usr["id"])
                                 st.session_state["user"] = usr
                                 qp_set(token=token)
@@ -1637,6 +2139,9 @@ if tab_forum is not None:
                                 if ext:
                                     okext = save_avatar_file(u["id"], up.getvalue(), ext)
                                     if okext:
+                                        # usuário da sessão não é relido do banco: atualiza a extensão aqui
+                                        u["avatar_ext"] = okext
+                                        u.pop("avatar_uri", None)
                                         st.toast("Avatar atualizado!")
                                         st.session_state["avatar_nonce"] += 1
                                         st.session_state["avatar_open"] = False
@@ -1649,9 +2154,13 @@ if tab_forum is not None:
                             st.session_state["avatar_open"] = False
                             st.experimental_rerun()
 
-            av_bytes = user_avatar_bytes(u["id"], u.get("avatar_ext"))
-            if av_bytes:
-                st.image(av_bytes, width=80)
+            # data URI do próprio avatar guardado no usuário da sessão; troca de extensão refaz
+            av_cached = u.get("avatar_uri")
+            if not av_cached or av_cached[0] != u.get("avatar_ext"):
+                av_cached = u["avatar_uri"] = (u.get("avatar_ext"), user_avatar_uri(u["id"], u.get("avatar_ext")))
+            av_uri = av_cached[1]
+            if av_uri:
+                st.markdown(avatar_html(av_uri, 80), unsafe_allow_html=True)
 
         st.markdown("---")
         st.subheader("Tópicos")
@@ -1704,7 +2213,10 @@ if tab_forum is not None:
                                 if not nt_title.strip():
                                     st.error("Informe um título.")
                                 else:
-                                    forum_create_post(cat, nt_title, nt_body, nt_imgs, u)
+                                    _, failed_imgs = forum_create_post(cat, nt_title, nt_body, nt_imgs, u)
+                                    if failed_imgs:
+                                        st.toast(f"Não foi possível salvar: {', '.join(failed_imgs)}", icon="⚠️")
+                                    st.session_state[f"forum_page_{cat}"] = 0  # tópico novo aparece na 1ª página
                                     for _k in (f"nt_title_{cat}", f"nt_body_{cat}"):
                                         st.session_state.pop(_k, None)
                                     st.session_state[nonce_key] += 1
@@ -1718,163 +2230,63 @@ if tab_forum is not None:
                     elif cat == "Atualizações" and u and u['is_admin'] != 1:
                         st.caption("_Apenas admin pode publicar em Atualizações._")
 
-                posts = forum_list_posts(cat)
+                # paginação: só a página atual é buscada/renderizada (+1 linha p/ saber se há próxima)
+                page_key = f"forum_page_{cat}"
+                page = st.session_state.get(page_key, 0)
+                posts = forum_list_posts(cat, FORUM_PAGE_SIZE + 1, page * FORUM_PAGE_SIZE)
+                has_next = len(posts) > FORUM_PAGE_SIZE
+                posts = posts[:FORUM_PAGE_SIZE]
                 if not posts:
                     st.info("Nenhum tópico ainda.")
                 else:
-                    for (pid, title, author_name, author_faction, cts, images_json, author_id) in posts:
-                        cnt = forum_count_comments(pid)
-                        user_row = get_db().execute("SELECT avatar_ext FROM users WHERE id=?", (int(author_id),)).fetchone()
-                        av_ext = user_row[0] if user_row else None
-                        avb = user_avatar_bytes(author_id, av_ext)
-                        can_edit_post = u and (u.get("is_admin",0)==1 or int(u["id"])==int(author_id))
-
-                        with st.container(border=True):
-                            head_cols = st.columns([0.10, 0.60, 0.30])
-                            with head_cols[0]:
-                                if avb:
-                                    st.image(avb, width=48)
-                            with head_cols[1]:
-                                dt = datetime.fromtimestamp(cts).strftime("%Y-%m-%d %H:%M")
-                                st.markdown(f"**{title}**  <span class='mf-badge'>{cnt} comentários</span><br><small>por {author_name} · {author_faction} · {dt}</small>", unsafe_allow_html=True)
-                            with head_cols[2]:
-                                colb1, colb2 = st.columns([1, 1], gap="small")
-                                with colb1:
-                                    if can_edit_post:
-                                        if st.button("Editar", key=f"edit_post_btn_{pid}", use_container_width=True):
-                                            st.session_state[f"edit_open_{pid}"] = True
-                                            st.experimental_rerun()
-                                with colb2:
-                                    if can_edit_post:
-                                        if st.button("Apagar", key=f"del_post_{pid}", use_container_width=True):
-                                            get_db().execute("DELETE FROM forum_posts WHERE id=?", (int(pid),))
-                                            get_db().execute("DELETE FROM forum_comments WHERE post_id=?", (int(pid),))
-                                            get_db().commit()
-                                            st.success("Tópico removido.")
-                                            st.experimental_rerun()
-
-                            post = forum_get_post(pid)
-                            if post:
-                                _id, _cat, _title, _body_md, _aid, _aname, _afac, _cts, _imgs = post
-                                if _body_md:
-                                    st.markdown(_body_md)
-                                try:
-                                    imgs = json.loads(_imgs or "[]")
-                                except:
-                                    imgs = []
-                                if imgs:
-                                    st.caption("Imagens:")
-                                    ig_cols = st.columns(min(3,len(imgs)))
-                                    root = os.path.join("data","posts",str(pid))
-                                    for i, name in enumerate(imgs):
-                                        p = os.path.join(root, name)
-                                        if os.path.exists(p):
-                                            with ig_cols[i % len(ig_cols)]:
-                                                st.image(open(p,"rb").read())
-
-                            if can_edit_post and st.session_state.get(f"edit_open_{pid}", False):
-                                with st.container(border=True):
-                                    st.markdown("#### Editar tópico")
-                                    et_title = st.text_input("Título", value=_title or title, key=f"et_title_{pid}")
-                                    et_body  = st.text_area("Conteúdo (Markdown)", value=_body_md or "", height=140, key=f"et_body_{pid}")
-                                    c1, c2 = st.columns([0.2,0.2])
-                                    save_clicked   = c1.button("Salvar",   key=f"et_save_{pid}")
-                                    cancel_clicked = c2.button("Cancelar", key=f"et_cancel_{pid}")
-                                    if save_clicked:
-                                        new_title = et_title.strip() or title
-                                        forum_update_post(pid, new_title, et_body or "")
-                                        st.session_state.pop(f"et_title_{pid}", None)
-                                        st.session_state.pop(f"et_body_{pid}", None)
-                                        st.session_state[f"edit_open_{pid}"] = False
-                                        st.toast("Tópico atualizado!")
-                                        st.experimental_rerun()
-                                    if cancel_clicked:
-                                        st.session_state.pop(f"et_title_{pid}", None)
-                                        st.session_state.pop(f"et_body_{pid}", None)
-                                        st.session_state[f"edit_open_{pid}"] = False
-                                        st.experimental_rerun()
-
-                            if COMMENTS_ENABLED:
-                                st.markdown("**Comentários:**")
-                                comms = forum_list_comments(pid)
-                                if not comms:
-                                    st.caption("Seja o primeiro a comentar.")
-                                else:
-                                    for (cid, caid, caname, cafac, cbody, ctime, cdel) in comms:
-                                        if cdel:
-                                            st.caption("_comentário removido_")
-                                            continue
-                                        row_cols = st.columns([0.1,0.9])
-                                        with row_cols[0]:
-                                            cav_row = get_db().execute("SELECT avatar_ext FROM users WHERE id=?", (int(caid),)).fetchone()
-                                            cav_ext = cav_row[0] if cav_row else None
-                                            cav_bytes = user_avatar_bytes(caid, cav_ext)
-                                            if cav_bytes:
-                                                st.image(cav_bytes, width=40)
-                                        with row_cols[1]:
-                                            line = f"**{caname}** · {cafac} · {datetime.fromtimestamp(ctime).strftime('%Y-%m-%d %H:%M')}"
-                                            st.markdown(line)
-                                            if cbody:
-                                                st.markdown(cbody)
-                                            if u and (u.get("is_admin",0)==1 or int(u["id"])==int(caid)):
-                                                if st.button("🗑️ Apagar", key=f"delc_{cid}"):
-                                                    forum_delete_comment(cid)
-                                                    st.success("Comentário apagado.")
-                                                    st.experimental_rerun()
-
-                                if u:
-                                    nonce_key_c = f"comment_nonce_{pid}"
-                                    if nonce_key_c not in st.session_state:
-                                        st.session_state[nonce_key_c] = 0
-                                    nc = st.text_area(
-                                        "Escreva um comentário",
-                                        key=f"nc_{pid}_{st.session_state[nonce_key_c]}",
-                                        height=100
-                                    )
-                                    if st.button("Comentar", key=f"btn_nc_{pid}"):
-                                        if not (nc or "").strip():
-                                            st.error("O comentário está vazio.")
-                                        else:
-                                            forum_add_comment(pid, u, nc)
-                                            st.session_state[nonce_key_c] += 1
-                                            st.toast("Comentário enviado!")
-                                            st.experimental_rerun()
-                                else:
-                                    st.caption("_Entre para comentar._")
-                            else:
-                                st.caption("_Comentários desabilitados._")
+                    for (pid, title, author_name, author_faction, cts, images_json, author_id, cnt, av_ext, body_md) in posts:
+                        render_post_card(pid, title, body_md, images_json, author_name, author_faction, cts, author_id, cnt, av_ext, u)
+
+                if page > 0 or has_next:
+                    pg_cols = st.columns([0.3, 0.4, 0.3])
+                    if page > 0 and pg_cols[0].button("◀ Anteriores", key=f"pg_prev_{cat}", use_container_width=True):
+                        st.session_state[page_key] = page - 1
+                        st.experimental_rerun()
+                    pg_cols[1].caption(f"Página {page + 1}")
+                    if has_next and pg_cols[2].button("Próximos ▶", key=f"pg_next_{cat}", use_container_width=True):
+                        st.session_state[page_key] = page + 1
+                        st.experimental_rerun()
 
 # ---------- Rodapé ----------
-st.markdown("---")
-left, right = st.columns(2)
-
 PIX_PHONE_DISPLAY = "+55 79 99834-5186"
 WHATS_NUMBER_DIGITS = "5579998345186"
 WHATS_URL = f"https://wa.me/{WHATS_NUMBER_DIGITS}"
-TELEGRAM_USER = st.secrets.get("TELEGRAM_USER", "@HiperionBR")
+TELEGRAM_USER = SECRETS["TELEGRAM_USER"]
 TELEGRAM_URL = f"https://t.me/{TELEGRAM_USER.lstrip('@')}"
 
-with left:
-    st.subheader("💙 Apoie este projeto")
-    pix_qr_url = st.secrets.get("PIX_QR_URL", "")
-    if pix_qr_url:
-        st.image(pix_qr_url, caption="Use o QR Code para doar via PIX", width=220)
-    st.markdown(f"Ou copie a chave PIX (celular): **{PIX_PHONE_DISPLAY}**")
-    st.markdown(f"[📲 Entrar em contato no WhatsApp]({WHATS_URL})", unsafe_allow_html=True)
-    st.markdown(f"[✈️ Falar no Telegram]({TELEGRAM_URL})", unsafe_allow_html=True)
-
-with right:
-    st.subheader("📰 Informes")
-    news_md = st.secrets.get("NEWS_MD", "").strip()
-    if news_md:
-        st.markdown(news_md)
-    else:
-        st.markdown(
-            '''
+# contatos num markdown só (1 elemento em vez de 3)
+FOOTER_CONTACTS_MD = (
+    f"Ou copie a chave PIX (celular): **{PIX_PHONE_DISPLAY}**\n\n"
+    f"[📲 Entrar em contato no WhatsApp]({WHATS_URL})\n\n"
+    f"[✈️ Falar no Telegram]({TELEGRAM_URL})"
+)
+
+NEWS_DEFAULT_MD = '''
 - Bem-vindo ao **Maxfield Online**!  
 - Você pode enviar portais via **arquivo**, **colar texto** ou pelo **plugin do IITC**.  
 - Feedbacks e ideias são muito bem-vindos.
   
 > Dica: para editar este bloco sem atualizar o código, adicione `NEWS_MD = """Seu markdown aqui"""` em `.streamlit/secrets.toml`.
             '''
-        )
+
+@_fragment
+def render_footer():
+    # conteúdo estático: rerun de fragmento (cartões do fórum) nunca passa por aqui
+    st.markdown("---")
+    left, right = st.columns(2)
+    with left:
+        st.subheader("💙 Apoie este projeto")
+        pix_qr_url = SECRETS["PIX_QR_URL"]
+        if pix_qr_url:
+            st.image(pix_qr_url, caption="Use o QR Code para doar via PIX", width=220)
+        st.markdown(FOOTER_CONTACTS_MD, unsafe_allow_html=True)
+    with right:
+        st.subheader("📰 Informes")
+        st.markdown(SECRETS["NEWS_MD"] or NEWS_DEFAULT_MD)
+
+render_footer()
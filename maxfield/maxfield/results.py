@@ -26,21 +26,34 @@ August 2020 - A complete re-write of original Ingress Maxfield.
 """
 
 import os
+import math
+import itertools
 import hashlib
 import hmac
 import base64
 import urllib.request
 import urllib.error
 from io import BytesIO
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 from matplotlib import image
 from matplotlib.patches import Polygon
-import imageio
+from PIL import Image, GifImagePlugin
 from pygifsicle import optimize
 
+# GIF frame duration (ms) and palette index reserved for
+# "unchanged since previous frame" pixels
+_GIF_FRAME_MS = 500
+_GIF_TRANSPARENT = 255
+
+# Pixel budget of the downscaled mosaic of all frames used to build
+# the shared GIF palette
+_GIF_PALETTE_PIXELS = 4000000
+
 # AP gained for various actions
 _AP_PER_PORTAL = 1750 # assuming capture and full resonator deployment
 _AP_PER_LINK = 313
@@ -732,11 +745,146 @@ class Results:
         # Generate GIF
         #
         fname = os.path.join(self.outdir, 'plan_movie.gif')
-        with imageio.get_writer(fname, mode='I', duration=0.5) as writer:
-            for frame in frames:
-                image = imageio.imread(frame)
-                writer.append_data(image)
+        write_gif(frames, fname)
         optimize(fname)
         if self.verbose:
             print("GIF saved to {0}".format(fname))
             print()
+
+
+def _palette_tile(frame, factor):
+    """
+    Decode one frame image and downscale it for the palette mosaic.
+
+    Inputs:
+      frame :: string
+        Path to the frame image
+      factor :: integer
+        Downscaling factor
+
+    Returns: tile
+      tile :: PIL.Image
+        Downscaled RGB frame
+    """
+    with Image.open(frame) as im:
+        return im.convert('RGB').reduce(factor)
+
+
+def _quantize_frame(frame, ref):
+    """
+    Decode one frame image and map it onto the shared palette.
+
+    Inputs:
+      frame :: string
+        Path to the frame image
+      ref :: PIL.Image
+        Image holding the shared palette
+
+    Returns: img
+      img :: PIL.Image
+        Palette-mode frame
+    """
+    with Image.open(frame) as im:
+        return im.convert('RGB').quantize(
+            palette=ref, dither=Image.Dither.NONE)
+
+
+def _quantized_frames(frames, ref):
+    """
+    Yield the quantized frames in order. Decoding and quantizing are
+    done by a thread pool (Pillow releases the GIL for both), with
+    only a few frames in flight at a time.
+
+    Inputs:
+      frames :: list of strings
+        Paths to the frame images, in order
+      ref :: PIL.Image
+        Image holding the shared palette
+
+    Returns: generator of PIL.Image
+    """
+    workers = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        todo = iter(frames)
+        pending = deque(pool.submit(_quantize_frame, frame, ref)
+                        for frame in itertools.islice(todo, 2*workers))
+        while pending:
+            img = pending.popleft().result()
+            frame = next(todo, None)
+            if frame is not None:
+                pending.append(pool.submit(_quantize_frame, frame, ref))
+            yield img
+
+
+def write_gif(frames, fname):
+    """
+    Stream PNG frames into an animated GIF.
+
+    The palette is computed once, from a downscaled mosaic of every
+    frame (so colors that only appear in some frames are kept), and
+    every frame is mapped onto it instead of being quantized on its
+    own. Frames are decoded and quantized
+    in parallel, ahead of the writer. Each frame after the first
+    is cropped to the region that changed since the previous frame,
+    with unchanged pixels inside that region left transparent. Only
+    the previous frame and the few decoded ahead are kept in memory.
+
+    Inputs:
+      frames :: list of strings
+        Paths to the frame images, in order
+      fname :: string
+        Output GIF path
+
+    Returns: Nothing
+    """
+    if not frames:
+        return
+    #
+    # Shared palette from all frames, each reduced enough for the
+    # mosaic to fit the pixel budget
+    #
+    with Image.open(frames[0]) as im:
+        width, height = im.size
+    factor = max(4, math.ceil(math.sqrt(
+        len(frames)*width*height/_GIF_PALETTE_PIXELS)))
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+        tiles = list(pool.map(_palette_tile, frames,
+                              itertools.repeat(factor)))
+    width, height = tiles[0].size
+    mosaic = Image.new('RGB', (width, height*len(tiles)))
+    for i, tile in enumerate(tiles):
+        mosaic.paste(tile, (0, height*i))
+    ref = mosaic.quantize(colors=_GIF_TRANSPARENT,
+                          method=Image.Quantize.FASTOCTREE)
+    prev = None
+    with open(fname, 'wb') as fp:
+        for img in _quantized_frames(frames, ref):
+            cur = np.asarray(img)
+            if prev is None:
+                for chunk in GifImagePlugin.getheader(
+                        img, info={'loop': 0})[0]:
+                    fp.write(chunk)
+                out, offset = img, (0, 0)
+            else:
+                #
+                # Bounding box of the changed pixels
+                #
+                diff = cur != prev
+                rows = np.flatnonzero(diff.any(axis=1))
+                cols = np.flatnonzero(diff.any(axis=0))
+                if rows.size:
+                    y0, y1 = rows[0], rows[-1]+1
+                    x0, x1 = cols[0], cols[-1]+1
+                else:
+                    y0, y1, x0, x1 = 0, 1, 0, 1
+                sub = np.where(diff[y0:y1, x0:x1], cur[y0:y1, x0:x1],
+                               _GIF_TRANSPARENT).astype(np.uint8)
+                out = Image.fromarray(sub)
+                out.putpalette(img.getpalette())  # L -> P
+                offset = (int(x0), int(y0))
+            for chunk in GifImagePlugin.getdata(
+                    out, offset=offset, duration=_GIF_FRAME_MS,
+                    transparency=_GIF_TRANSPARENT, disposal=1):
+                fp.write(chunk)
+            prev = cur
+        fp.write(b';')
@@ -26,7 +26,6 @@ January 2020 - A complete re-write of original Ingress Maxfield.
 """
 
 import itertools
-import functools
 import numpy as np
 from ortools.constraint_solver import pywrapcp
 from ortools.constraint_solver import routing_enums_pb2
@@ -42,12 +41,10 @@ _COMMTIME = 30
 # Seconds required to create a link
 _LINKTIME = 30
 
-def time_callback(origins_dists, count_cut_origins):
+def time_callback(origins_dists, count_cut_origins, manager):
     """
     Creates a callback to get total time between two portals. The
     total time between nodes A and B is action(A) + travel(A, B).
-    Ideally this would be a class function, but that doesn't work
-    with functools.partial for some reason...
 
     Inputs:
       origins_dists :: (M, M) array of integers
@@ -56,60 +53,34 @@ def time_callback(origins_dists, count_cut_origins):
       count_cut_origins :: N-length list of integers
         The number of times this portal is used as an origin
         consequtively. Does not include dummy depot portal.
+      manager :: pywrapcp.RoutingIndexManager object
+        Maps the solver's variable indices to nodes
 
     Returns: time_evaluator
       time_evaluator :: reference to function time_evaluator()
     """
 
-    def action_time(node):
-        """
-        Gets the action time at specified portal. The action time
-        depends on the number of outgoing links.
-
-        Inputs:
-          node :: integer
-            The portal under consideration.
-
-        Returns:
-          time :: integer
-            The time (seconds) spent linking and communicating at this
-            node
-        """
-        if node == 0:
-            # skip dummy depot
-            return 0
-        # N.B. node i corresponds to index i-1 in
-        # count_cut_origins, since count_cut_origins has no depot
-        return count_cut_origins[node-1]*_LINKTIME
-
-    def travel_time(from_node, to_node):
-        """
-        Determine the walking time between two portals.
-
-        Inputs:
-          from_index :: integer
-            The first portal
-          to_index :: integer
-            The second portal
-
-        Returns: time
-          time :: integer
-            The walking time between the two portals (seconds)
-            """
-        return origins_dists[from_node][to_node] / _WALKSPEED
-
     #
-    # Pre-compute total time.
+    # Pre-compute total time: action time at the origin (number of
+    # outgoing links; 0 at the dummy depot) broadcast over the walking
+    # time matrix. N.B. node i corresponds to index i-1 in
+    # count_cut_origins, since count_cut_origins has no depot. Stored
+    # as nested lists of python ints, which index faster than numpy
+    # scalars in the (very hot) solver callback.
     #
-    _total_time = {}
-    for from_node in range(len(origins_dists)):
-        _total_time[from_node] = {}
-        for to_node in range(len(origins_dists)):
-            _total_time[from_node][to_node] = \
-                (action_time(from_node) +
-                 travel_time(from_node, to_node))
+    origins_dists = np.asarray(origins_dists)
+    action = np.zeros(len(origins_dists), dtype=np.int64)
+    action[1:] = np.asarray(count_cut_origins, dtype=np.int64)*_LINKTIME
+    _total_time = (action[:, None] +
+                   origins_dists//_WALKSPEED).astype(np.int64).tolist()
+    #
+    # Index -> node table, so the callback makes no calls back into
+    # the solver
+    #
+    _node = [manager.IndexToNode(index)
+             for index in range(manager.GetNumberOfIndices())]
 
-    def time_evaluator(manager, from_index, to_index):
+    def time_evaluator(from_index, to_index):
         """
         The callback, which returns the total time (action + travel)
         between two nodes.
@@ -124,9 +95,7 @@ def time_callback(origins_dists, count_cut_origins):
           time :: integer
             The total time (seconds)
         """
-        from_node = manager.IndexToNode(from_index)
-        to_node = manager.IndexToNode(to_index)
-        return _total_time[from_node][to_node]
+        return _total_time[_node[from_index]][_node[to_index]]
 
     return time_evaluator
 
@@ -167,16 +136,22 @@ class Router:
         self.max_route_solutions = max_route_solutions
         self.max_route_runtime = max_route_runtime
         #
-        # Get links and origins in order
+        # Get links and origins in order (one pass over the edge
+        # data; ties on order broken by link, as before)
+        #
+        items = sorted(((data['order'], (u, v), data['depends'])
+                        for u, v, data in self.graph.edges(data=True)),
+                       key=lambda item: item[:2])
+        self.ordered_links = [link for _, link, _ in items]
+        self.ordered_origins = [link[0] for link in self.ordered_links]
+        self.ordered_links_depends = [depends for _, _, depends in items]
         #
-        link_orders = [self.graph.edges[link]['order']
-                       for link in self.graph.edges]
-        self.ordered_links = \
-            [link for _, link in sorted(
-                zip(link_orders, list(self.graph.edges)))]
-        self.ordered_origins = \
-            [link[0] for link in self.ordered_links]
-        self.ordered_links_depends = [graph.edges[link]['depends'] for link in self.ordered_links]
+        # Dependencies as sets for O(1) membership tests. Each
+        # depends list holds both links (tuples) and portals
+        # (integers), so one set covers both checks.
+        #
+        self._dep_sets = [frozenset(depends)
+                          for depends in self.ordered_links_depends]
 
     def route_agents(self):
         """
@@ -199,23 +174,20 @@ class Router:
         # the order is already set
         #
         if self.num_agents == 1:
-            assignments = []
-            for i in range(len(self.ordered_links)):
-                if i == 0:
-                    arrive = 0
-                else:
-                    arrive = (depart +
-                              self.portals_dists[
-                                  self.ordered_links[i-1][0],
-                                  self.ordered_links[i][0]
-                              ]//_WALKSPEED)
-                depart = arrive + _LINKTIME
-                location = self.ordered_links[i][0]
-                link = self.ordered_links[i][1]
-                assignments.append(
-                    {'agent':0, 'location':location, 'arrive':arrive,
-                     'link':link, 'depart':depart})
-            return assignments
+            #
+            # Each arrival is the previous departure plus the walk
+            # from the previous origin: one gather of the walk times
+            # and a cumulative sum
+            #
+            origins = np.asarray(self.ordered_origins, dtype=np.intp)
+            steps = np.full(len(origins), _LINKTIME, dtype=np.int64)
+            steps[:1] = 0  # first arrival at 0 (no-op without links)
+            steps[1:] += self.portals_dists[origins[:-1], origins[1:]]//_WALKSPEED
+            arrives = np.cumsum(steps).tolist()
+            return [{'agent':0, 'location':location, 'arrive':arrive,
+                     'link':link, 'depart':arrive + _LINKTIME}
+                    for (location, link), arrive in
+                    zip(self.ordered_links, arrives)]
         #
         # If the same origin appears multiple times sequentially, we
         # can remove the extras since the agent doesn't need to move.
@@ -226,12 +198,14 @@ class Router:
             zip(*[(x, len(list(y))) for x, y in
                   itertools.groupby(self.ordered_origins)])
         #
-        # Create origins_dists matrix, which has the distances between
-        # each origin portal in the correct order.
+        # first_link[k] is the index in ordered_links of the first
+        # link of the k-th cut origin (prefix sum of the counts)
         #
-        origins_dists = np.array([[self.portals_dists[o1][o2]
-                                   for o1 in ordered_cut_origins]
-                                  for o2 in ordered_cut_origins])
+        first_link = [0, *itertools.accumulate(count_cut_origins)]
+        #
+        # Create origins_dists matrix, which has the distances between
+        # each origin portal in the correct order (one numpy gather;
+        # portals_dists is symmetric).
         #
         # Optimize the agent routes. This is a vehicle routing
         # problem, with the constraint that each portal must be
@@ -244,11 +218,10 @@ class Router:
         # cause any problems since most (all?) portals are separated
         # by at least 1 meter.
         #
-        origins_dists = np.hstack(
-            (np.zeros((origins_dists.shape[0], 1)), origins_dists))
-        origins_dists = np.vstack(
-            (np.zeros(origins_dists.shape[1]), origins_dists))
-        origins_dists = np.array(origins_dists, dtype=int)
+        idx = np.fromiter(ordered_cut_origins, dtype=np.intp)
+        origins_dists = np.zeros((len(idx)+1, len(idx)+1), dtype=int)
+        origins_dists[1:, 1:] = \
+            np.asarray(self.portals_dists)[np.ix_(idx, idx)]
         #
         # Create the routing index manager
         # Set starting and ending locations to index 0 for the dummy
@@ -263,10 +236,10 @@ class Router:
         #
         # Set the time callback
         #
+        time_evaluator = time_callback(
+            origins_dists, count_cut_origins, manager)
         time_callback_index = routing.RegisterTransitCallback(
-            functools.partial(
-                time_callback(origins_dists, count_cut_origins),
-                manager))
+            time_evaluator)
         #
         # Set the cost function to minimize total time
         #
@@ -285,8 +258,10 @@ class Router:
         # Force order. If any of the links in the next group depend
         # on any of the links in this group, then the next group can't
         # be started until this one is finished. Otherwise, they can
-        # be built at the same time.
+        # be built at the same time. min_gap[i] is the minimum time
+        # between starting node i-1 and starting node i.
         #
+        min_gap = [0]*len(origins_dists)
         for i in range(1, len(origins_dists)-1):
             # N.B. node i corresponds to count_cut_origins[i-1] since
             # the later has no depot.
@@ -295,24 +270,13 @@ class Router:
             #
             # Get dependencies
             #
-            this_link = int(np.sum(count_cut_origins[:i-1]))
-            this_size = count_cut_origins[i-1]
-            next_link = int(np.sum(count_cut_origins[:i]))
-            next_size = count_cut_origins[i]
-            for linki in range(this_link, this_link+this_size):
-                for linkj in range(next_link, next_link+next_size):
-                    if ((self.ordered_links[linki] in
-                         self.ordered_links_depends[linkj]) or
-                        (self.ordered_links[linki][0] in
-                         self.ordered_links_depends[linkj])):
-                        # Dependency conflict
-                        break
-                else:
-                    # No conflict yet
-                    continue
-                # Dependency conflict
-                break
-            else:
+            this_links = range(first_link[i-1], first_link[i])
+            next_links = range(first_link[i], first_link[i+1])
+            conflict = any(
+                (self.ordered_links[linki] in self._dep_sets[linkj] or
+                 self.ordered_origins[linki] in self._dep_sets[linkj])
+                for linki in this_links for linkj in next_links)
+            if not conflict:
                 # No conflict, so they can be started simultaneously
                 routing.solver().Add(
                     (time_dimension.CumulVar(next_index) >=
@@ -320,6 +284,7 @@ class Router:
                 continue
             # is a conflict, so next has to be after this is finished
             # and communicated
+            min_gap[i+1] = count_cut_origins[i-1]*_LINKTIME + _COMMTIME + 1
             routing.solver().Add(
                 (time_dimension.CumulVar(next_index) >
                  (time_dimension.CumulVar(this_index) + 
@@ -344,18 +309,37 @@ class Router:
         #search_parameters.log_search = True
         routing.CloseModelWithParameters(search_parameters)
         #
-        # A naive initial solution is that agents alternate portals
-        #
-        naive_route = [
-            list(range(1, len(origins_dists)))[i::self.num_agents]
-            for i in range(self.num_agents)]
-        naive_solution = \
-            routing.ReadAssignmentFromRoutes(naive_route, True)
+        # Greedy initial solution: take the nodes in order (so every
+        # route respects the ordering constraints) and give each one
+        # to the agent who can start it earliest, given where they
+        # are, when they finish there, and the wait imposed by the
+        # previous node.
+        #
+        greedy_route = [[] for _ in range(self.num_agents)]
+        position = [routing.Start(agent)
+                    for agent in range(self.num_agents)]
+        start = [0]*self.num_agents
+        last_start = 0
+        for node in range(1, len(origins_dists)):
+            index = manager.NodeToIndex(node)
+            ready = last_start + min_gap[node] if node > 1 else 0
+            best_agent, best_start = 0, None
+            for agent in range(self.num_agents):
+                arrive = max(start[agent] +
+                             time_evaluator(position[agent], index),
+                             ready)
+                if best_start is None or arrive < best_start:
+                    best_agent, best_start = agent, arrive
+            greedy_route[best_agent].append(node)
+            position[best_agent] = index
+            start[best_agent] = last_start = best_start
+        greedy_solution = \
+            routing.ReadAssignmentFromRoutes(greedy_route, True)
         #
         # Solve with initial solution
         #
         solution = routing.SolveFromAssignmentWithParameters(
-            naive_solution, search_parameters)
+            greedy_solution, search_parameters)
         if not solution:
             raise ValueError("No valid assignments found")
         #
@@ -380,7 +364,7 @@ class Router:
                 # ordered_cut_origins doesn't have depot. This is
                 # related to the index in ordered_links via
                 #
-                linki = int(np.sum(count_cut_origins[:node-1]))
+                linki = first_link[node-1]
                 #
                 # Loop over all links starting now at this origin
                 #
@@ -8,6 +8,6 @@ setup(
     author_email='tvwenger@gmail.com',
     packages=['maxfield'],
     install_requires=['numpy', 'networkx', 'scipy', 'ortools', 'protobuf==3.19.4',
-                      'matplotlib', 'imageio', 'pygifsicle'],
+                      'matplotlib', 'pillow', 'pygifsicle'],
     scripts=['bin/maxfield-plan'],
 )
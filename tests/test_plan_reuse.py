@@ -0,0 +1,57 @@
+import os
+import glob
+import time
+import zipfile
+
+from streamlit.testing.v1 import AppTest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PORTAIS = "\n".join([
+    "P1; https://intel.ingress.com/intel?pll=-10.912345,-37.065432",
+    "P2; https://intel.ingress.com/intel?pll=-10.913210,-37.061234",
+    "P3; https://intel.ingress.com/intel?pll=-10.910987,-37.060001",
+    "P4; https://intel.ingress.com/intel?pll=-10.911500,-37.063000",
+])
+
+
+def _gerar_plano(at: AppTest, timeout_s: float = 120) -> None:
+    at.text_area(key="txt_content").input(PORTAIS)
+    at.checkbox(key="no_bg_map").check()
+    at.checkbox(key="out_gif").check()
+    next(b for b in at.button if "Gerar plano" in str(b.label)).click()
+    at.run()
+    t0 = time.time()
+    while not any("Plano gerado" in s.value for s in at.success):
+        assert time.time() - t0 < timeout_s, "plano não terminou"
+        time.sleep(0.5)
+        at.run()
+    assert not at.exception
+
+
+def test_plano_repetido_reaproveita_artefatos_com_frames(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(REPO)
+    at = AppTest.from_file(os.path.join(REPO, "app.py"), default_timeout=120)
+    at.secrets["ENABLE_FORUM"] = False
+    at.run()
+
+    _gerar_plano(at)
+    _gerar_plano(at)
+
+    jobs = sorted(glob.glob(os.path.join("data", "jobs", "*")), key=os.path.getmtime)
+    assert len(jobs) == 2
+    original, reusado = jobs
+
+    with open(os.path.join(reusado, "maxfield_log.txt"), encoding="utf-8") as f:
+        assert "artefatos reaproveitados" in f.read()
+
+    def nomes_zip(job):
+        (zpath,) = glob.glob(os.path.join(job, "*.zip"))
+        with zipfile.ZipFile(zpath) as z:
+            return set(z.namelist())
+
+    esperado = nomes_zip(original)
+    assert any(n.startswith("frames/frame_") for n in esperado)
+    assert "plan_movie.gif" in esperado
+    assert nomes_zip(reusado) == esperado
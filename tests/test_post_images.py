@@ -0,0 +1,37 @@
+import ast
+import io
+import os
+
+from PIL import Image
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _load_encode_post_image():
+    # app.py é o script do Streamlit (importar executa a UI): carrega só a função
+    with open(os.path.join(REPO, "app.py"), encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    fn = next(n for n in tree.body if isinstance(n, ast.FunctionDef) and n.name == "_encode_post_image")
+    ns = {"io": io}
+    exec(compile(ast.Module([fn], []), "app.py", "exec"), ns)
+    return ns["_encode_post_image"]
+
+
+def test_jpeg_com_orientacao_exif_sai_rotacionado():
+    encode = _load_encode_post_image()
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Orientation: girar 90° (foto em pé de celular)
+    buf = io.BytesIO()
+    Image.new("RGB", (40, 20), "red").save(buf, "JPEG", exif=exif)
+
+    ext, data = encode(buf.getvalue(), ".jpg")
+
+    assert ext == ".webp"
+    with Image.open(io.BytesIO(data)) as im:
+        assert im.format == "WEBP"
+        assert im.size == (20, 40)
+
+
+def test_bytes_invalidos_mantem_extensao_original():
+    encode = _load_encode_post_image()
+    assert encode(b"not an image", ".png") == (".png", b"not an image")